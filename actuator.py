@@ -0,0 +1,71 @@
+# actuator.py - door actuator thread for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import queue
+import threading
+import logging
+
+
+class Actuator(object):
+    """runs moves one at a time on a worker thread
+
+    A move is a callable taking a threading.Event; it should stop early
+    if the event gets set. Submitting a move cancels the one under way,
+    so a new command (or the opposite direction) takes over at once.
+    """
+
+    def __init__(self, name="actuator"):
+        self.queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.busy = False
+        self.idle = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, move):
+        """cancel whatever is running and queue move to run next"""
+        with self.idle:
+            # drop anything still waiting; only the latest command counts
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.busy = True
+            self.cancel_event.set()
+            self.queue.put(move)
+
+    def cancel(self):
+        """stop the running move, if any"""
+        self.cancel_event.set()
+
+    def superseded(self):
+        """true if another move is waiting to take over"""
+        return not self.queue.empty()
+
+    def is_busy(self):
+        return self.busy
+
+    def wait(self, timeout=None):
+        """block until no move is running or queued"""
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.busy, timeout)
+
+    def _run(self):
+        while True:
+            move = self.queue.get()
+            with self.idle:
+                self.cancel_event.clear()
+                # replaced before it even started
+                skip = not self.queue.empty()
+            if not skip:
+                try:
+                    move(self.cancel_event)
+                except:
+                    logging.exception("Actuator:Move failed")
+            with self.idle:
+                if self.queue.empty():
+                    self.busy = False
+                    self.idle.notify_all()
@@ -0,0 +1,308 @@
+# bench.py - benchmarks for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+# Times the controller's hot paths against the fakes in simulation.py,
+# so nothing real is touched: the light checks, sms command parsing,
+# capture and encode, change detection, the doorway check (on frames
+# recorded with vision.py --record, if there are any), status page
+# generation and a door move (with its step timing jitter).
+#
+#   python benchmarks/bench.py                 # run and compare to baseline
+#   python benchmarks/bench.py --save          # run and make it the baseline
+#   python benchmarks/bench.py light door      # just some of them
+#
+# Baselines are kept per machine type (baseline-armv7l.json and so on)
+# next to this file and committed with it, so numbers from the Pi are
+# only ever compared with numbers from the Pi. A machine type with no
+# baseline yet gets one with --save, run on that machine. Every metric is lower-is-better; anything more
+# than --threshold worse than its baseline is flagged, and we exit 1.
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import simulation    # installs the fake GPIO; must come before config
+import config
+import clock
+import sftpsession
+import argparse
+import json
+import platform
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+import logging
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+THRESHOLD = 0.15     # fraction worse than baseline that counts as a regression
+
+
+def measure(fn, repeat=5, number=1, setup=None):
+    """returns min and median secs per call of fn over repeat rounds
+
+    setup, if given, runs before each round, untimed.
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for j in range(number):
+            fn()
+        times.append((time.perf_counter() - start) / number)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def _configure(workdir):
+    config.DOOR_STATE_FILE = os.path.join(workdir, "door.state")
+    config.DOOR_JOURNAL_FILE = os.path.join(workdir, "door.journal")
+    config.DOOR_SNAPSHOT_FILE = os.path.join(workdir, "door.snapshot")
+    config.STATUS_FILE = os.path.join(workdir, "status.html")
+    config.STATUS_JSON_FILE = os.path.join(workdir, "status.json")
+    config.NOIMAGE_FILE = os.path.join(os.path.dirname(BENCH_DIR), "image-not-available.png")
+    config.ARCHIVE_IMAGES = False
+    config.LOCAL_SERVER_PORT = 0
+    config.CAMERA_WARM = False
+    config.SEND_RETRY_DELAY = 0
+    sftpsession.set_session(simulation.FakeSftpSession())
+
+
+def bench_light():
+    from light import Light
+    light = Light(config.CITY_NAME, config.LATITUDE, config.LONGITUDE,
+                  config.SUNRISE_DELAY, config.SUNSET_DELAY)
+    now = clock.now()
+    # a year of distinct days, to see the cost of a cache miss too
+    days = [now + timedelta(d) for d in range(365)]
+    def year():
+        for day in days:
+            light.is_dark(day)
+    return {
+        "is_dark": measure(light.is_dark, number=1000)["median"],
+        "report": measure(light.report, number=200)["median"],
+        "is_dark_uncached": measure(year, repeat=3, setup=light.cache.clear)["median"] / len(days),
+    }
+
+def bench_commands(count=1000):
+    from comms import Comms
+    from commands import CommandRegistry
+    twilio = simulation.FakeTwilio(config.ORIGIN_NUM)
+    registry = CommandRegistry()
+    for name in ("help", "photo", "close", "open", "stop", "status", "door", "sun", "cam"):
+        registry.register(name, lambda num, args: None)
+    comms = Comms(config.ORIGIN_NUM, config.TARGET_NUMS, registry, twilio)
+    bodies = simulation.SMS_BODIES + ["Could you please send a photo of the girls?",
+                                      "what's the status of the door right now"]
+    def fill():
+        twilio.inbox.clear()
+        for i in range(count):
+            from_num = simulation.STRANGER_NUM if i % 10 == 0 else config.TARGET_NUMS[i % len(config.TARGET_NUMS)]
+            twilio.receive(from_num, bodies[i % len(bodies)])
+        comms.last_fetch = clock.now() - timedelta(minutes=60)
+    result = measure(comms.check_for_commands, setup=fill)
+    comms.executor.shutdown()
+    return {"check_for_commands": result["median"],
+            "per_message": result["median"] / count}
+
+def bench_camera(cams=2):
+    from camera import Camera
+    camera = Camera(config.MAX_HORZ, config.MAX_VERT,
+                    lambda cam_num: simulation.FakeCapture(cam_num, cams))
+    # the camlight waits are fixed sleeps, not work; skip them
+    clock.set_clock(clock.SimClock())
+    try:
+        capture = measure(camera._take_all_images, repeat=3)
+        camera.mms_quality_array = {}
+        encode_cold = measure(camera._encode_images, repeat=1)
+        encode = measure(camera._encode_images, repeat=3)
+    finally:
+        clock.set_clock(clock.Clock())
+    return {"capture": capture["median"],
+            "encode_first": encode_cold["median"],
+            "encode": encode["median"]}
+
+def bench_change(frames=20):
+    from change import ChangeDetector
+    cam = simulation.FakeCapture(0, 1)
+    still = cam.read()[1][:, :, 0].copy()
+    # every other frame has a chicken-sized block moved into view
+    moved = still.copy()
+    block = config.MAX_VERT // 8
+    moved[-2 * block:-block, -2 * block:-block] = 220
+    detector = ChangeDetector()
+    images = [still if i % 2 == 0 else moved for i in range(frames)]
+    detector.check(0, still)
+    def run():
+        for image in images:
+            detector.check(0, image)
+    return {"check": measure(run, repeat=5)["median"] / frames}
+
+def bench_vision(count=8):
+    import vision
+    from camera import resize_to_width
+    bursts = []
+    if os.path.isdir(config.VISION_RECORD_DIR):
+        bursts = [frames for name, frames in vision.load_bursts(config.VISION_RECORD_DIR)]
+    if not bursts:
+        # no recorded doorway; every other burst has something crossing it
+        cam = simulation.FakeCapture(0, 1)
+        still = resize_to_width(cam.read()[1][:, :, 0].copy(), config.VISION_WIDTH)
+        for n in range(count):
+            frames = []
+            for i in range(config.VISION_FRAMES):
+                frame = still.copy()
+                if n % 2:
+                    size = frame.shape[0] // 4
+                    frame[size:2 * size, i * size:(i + 1) * size] = 220
+                frames.append(frame)
+            bursts.append(frames)
+    classifier = vision.DoorwayClassifier(**vision.classifier_settings())
+    def classify():
+        for frames in bursts:
+            classifier.classify(frames)
+    result = {"classify": measure(classify)["median"] / len(bursts)}
+    # a generous budget, so a slow answer is timed rather than dropped
+    worker = vision.VisionWorker(budget=60).start()
+    try:
+        # the first answer waits for the worker to start up
+        worker.check(bursts[0])
+        def round_trip():
+            for frames in bursts:
+                worker.check(frames)
+        result["round_trip"] = measure(round_trip, repeat=3)["median"] / len(bursts)
+    finally:
+        worker.stop()
+    return result
+
+def bench_status():
+    from comms import Comms
+    comms = Comms(config.ORIGIN_NUM, config.TARGET_NUMS, None, simulation.FakeTwilio(config.ORIGIN_NUM))
+    renditions = {
+        "full": [f"image.{i}.jpg" for i in range(4)],
+        "mms": [f"image.{i}.mms.jpg" for i in range(4)],
+        "thumb": [f"image.{i}.thumb.jpg" for i in range(4)],
+    }
+    status_text = "Hi! I'm on duty. The doors are open. I have 4 cameras watching. It is light now. "
+    count = iter(range(1000000))
+    # a new status each time, so every call renders and uploads
+    changed = measure(lambda: comms.upload_status(status_text + str(next(count)),
+                                                  "Here's photos of the coop. ", renditions),
+                      number=50)
+    # the same status again, so every call is skipped
+    unchanged = measure(lambda: comms.upload_status(status_text, "Here's photos of the coop. ", renditions),
+                        number=50)
+    comms.executor.shutdown()
+    return {"upload_status": changed["median"],
+            "upload_unchanged": unchanged["median"]}
+
+def bench_door(revs=1):
+    import door
+    import motion
+    import planner
+    # played through the simulator in real time, so the step edges land
+    # only as close to their deadlines as python and the OS allow
+    config.STEPPER_BACKEND = "sim"
+    test_door = door.Door(revs)
+    test_door.stepper = motion.SimulatedBackend(config.DIR_PIN, config.STEP_PIN, realtime=True)
+    means, worsts, overruns = [], [], []
+    for state in (door.OPEN, door.CLOSED, door.OPEN, door.CLOSED):
+        move = planner.plan_move(state, test_door.total_steps, door.STEP_DELAY)
+        start = time.perf_counter()
+        test_door._move_door(state)
+        test_door.wait()
+        overruns.append(time.perf_counter() - start - motion.move_duration(move))
+        mean, worst = planner.timing_error(move.half_periods, test_door.stepper.edges)
+        means.append(mean)
+        worsts.append(worst)
+    test_door.journal.close()
+    return {"jitter_mean": statistics.median(means),
+            "jitter_worst": max(worsts),
+            "move_overrun": statistics.median(overruns)}
+
+BENCHMARKS = {
+    "light": bench_light,
+    "commands": bench_commands,
+    "camera": bench_camera,
+    "change": bench_change,
+    "vision": bench_vision,
+    "status": bench_status,
+    "door": bench_door,
+}
+
+
+def baseline_path():
+    return os.path.join(BENCH_DIR, f"baseline-{platform.machine() or 'unknown'}.json")
+
+def compare(results, baseline, threshold):
+    """returns a list of (name, metric, baseline, now, ratio) regressions"""
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get("results", {}).get(name, {}).get(metric)
+            if old and value > old * (1 + threshold):
+                regressions.append((name, metric, old, value, value / old))
+    return regressions
+
+def _format(value):
+    if value < 1e-3:
+        return f"{value * 1e6:.1f}us"
+    if value < 1:
+        return f"{value * 1e3:.2f}ms"
+    return f"{value:.2f}s"
+
+def main():
+    parser = argparse.ArgumentParser(description="time chickenrobot's hot paths")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run (of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--save", action="store_true", help="save these results as the baseline")
+    parser.add_argument("--baseline", default=None, help="baseline file (default per machine type)")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="fraction worse than baseline to flag")
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.WARNING
+    )
+    names = args.names or list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark {', '.join(unknown)}")
+    path = args.baseline or baseline_path()
+    baseline = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as file:
+            baseline = json.load(file)
+    _configure(tempfile.mkdtemp(prefix="chickenrobot-bench-"))
+    results = {}
+    for name in names:
+        results[name] = BENCHMARKS[name]()
+        for metric, value in results[name].items():
+            old = baseline.get("results", {}).get(name, {}).get(metric)
+            change = f"  ({(value / old - 1) * 100:+.0f}%)" if old else ""
+            print(f"{name + '.' + metric:32} {_format(value):>10}{change}")
+    regressions = compare(results, baseline, args.threshold)
+    for name, metric, old, value, ratio in regressions:
+        print(f"REGRESSION {name}.{metric}: {_format(old)} -> {_format(value)} "
+              f"({(ratio - 1) * 100:+.0f}%)")
+    if args.save:
+        if baseline.get("results"):
+            # keep baselines for benchmarks we didn't run this time
+            merged = dict(baseline["results"])
+            merged.update(results)
+            results = merged
+        with open(path, 'w') as file:
+            json.dump({"machine": platform.machine(),
+                       "python": platform.python_version(),
+                       "saved": datetime.now().isoformat(timespec="seconds"),
+                       "results": results}, file, indent=2, sort_keys=True)
+        print(f"Saved baseline to {path}")
+    elif not baseline:
+        print(f"No baseline at {path}; run with --save to make one")
+    sys.exit(1 if regressions and not args.save else 0)
+
+if __name__ == '__main__':
+    main()
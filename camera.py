@@ -5,27 +5,84 @@
 
 import config
 import sys
-import os
 import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 if sys.platform == "darwin":
     # OS X
     import fake_rpi
     sys.modules['RPi'] = fake_rpi.RPi     # Fake RPi
     sys.modules['RPi.GPIO'] = fake_rpi.RPi.GPIO # Fake GPIO
     # sys.modules['smbus'] = fake_rpi.smbus # Fake smbus (I2C)
-import RPi.GPIO as GPIO
-import cv2 as cv
-import os
-from time import sleep
-import pysftp
+from lazyimport import lazy_import
+import time
+from grabber import FrameGrabber
+from imagesync import ImageSync
+from change import ChangeDetector
+import clock
+import metrics
+import motion
 import logging
 
+# cv2 takes seconds to import on a Pi; only do it when we first need it
+cv = lazy_import("cv2")
+GPIO = lazy_import("RPi.GPIO")
+
 # CONSTANTS
 LIGHT_OFF = 1
 LIGHT_ON = 0
+# sizes we upload each photo at
+RENDITIONS = ["full", "mms", "thumb"]
+
+def encode_jpeg(image, quality=None, progressive=None, optimize=None):
+    """returns image encoded as jpeg bytes, or None if encoding failed"""
+    if quality is None:
+        quality = config.JPEG_QUALITY
+    if progressive is None:
+        progressive = config.JPEG_PROGRESSIVE
+    if optimize is None:
+        optimize = config.JPEG_OPTIMIZE
+    params = [cv.IMWRITE_JPEG_QUALITY, int(quality),
+              cv.IMWRITE_JPEG_PROGRESSIVE, int(bool(progressive)),
+              cv.IMWRITE_JPEG_OPTIMIZE, int(bool(optimize))]
+    ok, buf = cv.imencode('.jpg', image, params)
+    if not ok:
+        return None
+    return buf.tobytes()
+
+def encode_jpeg_to_budget(image, max_bytes, start_quality=None):
+    """returns (jpeg bytes, quality) for the best quality under max_bytes
+
+    If start_quality (e.g. what worked for this cam last time) fits, that
+    costs a single encode; otherwise we binary search down from it. If
+    even MMS_MIN_QUALITY is too big, that is what you get.
+    """
+    lo = config.MMS_MIN_QUALITY
+    hi = config.JPEG_QUALITY
+    if start_quality is not None:
+        data = encode_jpeg(image, start_quality)
+        if data is not None and len(data) <= max_bytes:
+            return data, start_quality
+        hi = start_quality - 1
+    best = None
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = encode_jpeg(image, quality)
+        if data is not None and len(data) <= max_bytes:
+            best = (data, quality)
+            lo = quality + 1
+        else:
+            hi = quality - 1
+    if best is None:
+        best = (encode_jpeg(image, config.MMS_MIN_QUALITY), config.MMS_MIN_QUALITY)
+    return best
 
-logging.getLogger("paramiko").setLevel(config.SFTP_LOG_LEVEL)
-logging.getLogger('paramiko.transport').setLevel(config.SFTP_LOG_LEVEL)
+def resize_to_width(image, width):
+    """returns image scaled down to width (never up), keeping its aspect"""
+    h, w = image.shape[:2]
+    if w <= width:
+        return image
+    return cv.resize(image, (width, round(h * width / w)), interpolation=cv.INTER_AREA)
 
 # NOTE: max resolution of the hbv-1615 is 1280x1024
 # If you switch to another cam, you may have to adjust this
@@ -33,27 +90,87 @@ logging.getLogger('paramiko.transport').setLevel(config.SFTP_LOG_LEVEL)
 class Camera(object):
     """Takes photos with USB cameras"""
 
-    def __init__(self, max_horz, max_vert):
+    def __init__(self, max_horz, max_vert, capture_factory=None, on_change=None):
         self.max_h = max_horz
         self.max_v = max_vert
+        # what opens a cam by number (cv.VideoCapture if None); a
+        # simulation swaps in fakes
+        self.capture_factory = capture_factory
+        # called with a change.Change when a cam sees its view change,
+        # on whichever thread took the photos
+        self.on_change = on_change
+        self.detector = ChangeDetector() if config.CHANGE_DETECTION else None
+        # when each cam's current photo was taken; an unchanged view
+        # reuses it until it's CHANGE_MAX_REUSE old
+        self.encoded_at = {}
+        # whether the remote dir got our last set of photos
+        self.images_synced = False
         self.cam_array = []
+        self.cam_num_array = []
+        self.grabbers = []
         self.image_array = []
+        # the device number of the cam each photo in image_array came
+        # from, and of each photo in the latest encoded set
+        self.image_cams = []
+        self.latest_cams = []
         self.image_filename_array = []
+        self.image_data_array = []
+        self.renditions = {rendition: [] for rendition in RENDITIONS}
+        # (renditions, {filename: jpeg bytes}) of the newest set, and the
+        # set before it, for the local server; each is swapped in whole
+        self.latest = ({}, {})
+        self.previous = ({}, {})
+        self.mms_quality_array = {}
+        self.image_sync = ImageSync(config.SFTP_IMAGE_DIR)
+        self.capture_lock = threading.Lock()
+        self.capture_started = None
+        self.noimage = None
+        self.discovery = None
+        self.discovery_lock = threading.Lock()
         self._setup_camlight()
+
+    def discover(self):
+        """count our cams on a background thread; returns the thread
+
+        Probing MAX_CAMS devices (and importing cv2 to do it) is slow, so
+        we do it once the control loop is running. Anything that needs
+        the cams waits for it, starting it if nobody has yet.
+        """
+        with self.discovery_lock:
+            if self.discovery is None:
+                self.discovery = threading.Thread(target=self._discover, name="camera-discovery",
+                                                  daemon=True)
+                self.discovery.start()
+        return self.discovery
+
+    def _discover(self):
         # we will find and setup cams before each photo,
         # but for now we want the count of how many cams we have
-        self._find_cams()
-        # self._setup_cams()
-        self._release_cams()
-        self.noimage = cv.imread(config.NOIMAGE_FILE)
+        try:
+            self._find_cams()
+            # self._setup_cams()
+            self._release_cams()
+            self.noimage = cv.imread(config.NOIMAGE_FILE)
+        except:
+            logging.exception("Camera:Failed to look for cameras")
+
+    def _wait_for_discovery(self):
+        self.discover().join()
+
+    def _open_cam(self, cam_num):
+        if self.capture_factory is not None:
+            return self.capture_factory(cam_num)
+        return cv.VideoCapture(cam_num)
 
     def _find_cams(self):
         """find usb cams"""
         self.cam_array = []
+        self.cam_num_array = []
         for cam_num in range(config.MAX_CAMS):
-            cam = cv.VideoCapture(cam_num)
+            cam = self._open_cam(cam_num)
             if cam is not None and cam.isOpened():
                 self.cam_array.append(cam)
+                self.cam_num_array.append(cam_num)
                 logging.debug("Camera:Camera %s found", str(cam_num))
             else:
                 logging.debug("Camera:Camera %s not found", str(cam_num))
@@ -71,7 +188,7 @@ class Camera(object):
 
     def _setup_camlight(self):
         try:
-            GPIO.setmode(config.PINOUT_SCHEME)
+            GPIO.setmode(motion.pin_numbering())
             GPIO.setup(config.CAMLIGHT_PIN, GPIO.OUT)
             GPIO.output(config.CAMLIGHT_PIN, LIGHT_OFF)
         except:
@@ -85,12 +202,16 @@ class Camera(object):
 
     def _take_image(self, cam_num):
         logging.debug("Camera:_take_image(%s)", str(cam_num))
+        raw_im = None
         # capture image
         try:
             logging.info("Camera:Taking photo")
             s, raw_im = self.cam_array[cam_num].read()
         except:
             logging.warning("Camera:Failed to take photo")
+        return self._filter_image(raw_im)
+
+    def _filter_image(self, raw_im):
         logging.debug("Camera:Filtering photo")
         if raw_im is not None:
             im = cv.cvtColor(raw_im, cv.COLOR_BGR2GRAY)
@@ -98,78 +219,354 @@ class Camera(object):
             im = raw_im
         return(im)
 
+    def _take_image_at_barrier(self, cam_num, barrier):
+        """wait until the camlight is up, then take the photo"""
+        barrier.wait(config.CAPTURE_TIMEOUT)
+        return self._take_image(cam_num)
+
     def _take_all_images(self):
+        self._wait_for_discovery()
+        # a live view holds its cam open, so a cold capture couldn't open it
+        if config.CAMERA_WARM or any(grabber.is_running() for grabber in self.grabbers):
+            self._take_all_images_warm()
+        else:
+            self._take_all_images_cold()
+
+    def _make_grabbers(self):
+        if not self.grabbers:
+            self.grabbers = [FrameGrabber(cam_num, self.max_h, self.max_v)
+                             for cam_num in self.cam_num_array]
+
+    def _start_grabbers(self):
+        """hold each cam we found at startup open in a grabber thread"""
+        self._make_grabbers()
+        for grabber in self.grabbers:
+            grabber.start()
+
+    def stop_grabbers(self):
+        for grabber in self.grabbers:
+            grabber.stop()
+
+    def _take_all_images_warm(self):
+        # cams are already open and draining their buffers, so we only
+        # need a frame from each that was read after the light came on
+        self._start_grabbers()
+        self.turn_on_camlight()
+        with metrics.stage("camlight_wait"):
+            clock.sleep(0.5)
+        lit_time = time.time()
+        deadline = lit_time + config.CAPTURE_TIMEOUT
+        self.image_array = []
+        self.image_cams = [grabber.cam_num for grabber in self.grabbers]
+        for grabber in self.grabbers:
+            logging.info("Camera:Taking photo")
+            raw_im = grabber.snapshot(lit_time, max(0, deadline - time.time()))
+            image = self._filter_image(raw_im)
+            if image is not None:
+                self.image_array.append(image)
+            else:
+                self.image_array.append(self.noimage)
+        self.turn_off_camlight()
+
+    def _take_all_images_cold(self):
         # find and setup cams
         #   - inefficient but prevents opencv's frame buffer problems
         self._find_cams()
         self._setup_cams()
+        cam_count = len(self.cam_array)
+        self.image_array = []
+        self.image_cams = list(self.cam_num_array)
+        # one worker per cam, all held at a barrier until the light is
+        # on, so every frame comes from the same lit window and the
+        # capture takes as long as the slowest cam rather than the sum
+        barrier = threading.Barrier(cam_count + 1)
+        executor = ThreadPoolExecutor(max_workers=max(1, cam_count))
+        futures = [executor.submit(self._take_image_at_barrier, cam_num, barrier)
+                   for cam_num in range(cam_count)]
         # turn on camlight
         self.turn_on_camlight()
-        sleep(0.5)
-        self.image_array = []
-        for cam_num in range(config.ACTIVE_CAMS):
-            image = self._take_image(cam_num)
+        with metrics.stage("camlight_wait"):
+            clock.sleep(0.5)
+        try:
+            barrier.wait(config.CAPTURE_TIMEOUT)
+        except threading.BrokenBarrierError:
+            logging.warning("Camera:Cameras not ready in time")
+        wait(futures, timeout=config.CAPTURE_TIMEOUT)
+        for cam_num, future in enumerate(futures):
+            image = None
+            if not future.done():
+                logging.warning("Camera:Camera %s timed out", str(cam_num))
+            elif future.exception() is not None:
+                logging.warning("Camera:Camera %s failed:%s", str(cam_num), future.exception())
+            else:
+                image = future.result()
             if image is not None:
                 self.image_array.append(image)
             else:
-                # TODO: Replace with "Image Not Available" image
                 self.image_array.append(self.noimage)
-        sleep(0.5)
+        with metrics.stage("camlight_wait"):
+            clock.sleep(0.5)
         self.turn_off_camlight()
-        # turn off cams
+        executor.shutdown(wait=False)
+        # turn off cams, leaving any still stuck in read() to be
+        # released when they finally return
+        for cam, future in list(zip(self.cam_array, futures)):
+            if not future.done():
+                future.add_done_callback(lambda f, cam=cam: cam.release())
+                self.cam_array.remove(cam)
         self._release_cams()
 
-    def _write_images(self):
+    def _encode_rendition(self, image_num, image, rendition):
+        """returns jpeg bytes of one rendition of an image"""
+        if rendition == "thumb":
+            return encode_jpeg(resize_to_width(image, config.THUMB_WIDTH))
+        if rendition == "mms":
+            # frames from one cam compress much alike from shot to shot, so
+            # start from the quality that fit the budget last time
+            small = resize_to_width(image, config.MMS_WIDTH)
+            cam_quality = self.mms_quality_array.get(image_num)
+            data, quality = encode_jpeg_to_budget(small, config.MMS_MAX_BYTES, cam_quality)
+            if data is not None and len(data) < config.MMS_MAX_BYTES * 3 // 4 and quality < config.JPEG_QUALITY:
+                # plenty of room; aim a little higher next time
+                quality = min(quality + 5, config.JPEG_QUALITY)
+            self.mms_quality_array[image_num] = quality
+            return data
+        return encode_jpeg(image)
+
+    def _detect_changes(self):
+        """returns {image_num: latest_num} of photos whose last ones can stand in"""
+        if self.detector is None:
+            return {}
+        # skip the noimage placeholder of a cam that timed out or failed;
+        # cams go by device number, so one going missing can't put
+        # another against its background
+        photos = [(image_num, cam, image)
+                  for image_num, (cam, image) in enumerate(zip(self.image_cams, self.image_array))
+                  if image is not None and image is not self.noimage]
+        with metrics.stage("change_detect"):
+            changes = [(image_num, cam, self.detector.check(cam, image)) for image_num, cam, image in photos]
+        now = clock.time()
+        reuse = {}
+        for image_num, cam, change in changes:
+            if change is None:
+                continue
+            if change.changed:
+                logging.info("Camera:Camera %s saw a change in %.1f%% of its view",
+                             cam, change.fraction * 100)
+                metrics.inc("camera_changes_total", result="changed")
+                if self.on_change:
+                    self.on_change(change)
+                continue
+            latest_num = self._reusable(cam, now)
+            if latest_num is not None:
+                logging.debug("Camera:Camera %s unchanged, reusing its photo", cam)
+                metrics.inc("camera_changes_total", result="unchanged")
+                reuse[image_num] = latest_num
+        return reuse
+
+    def _reusable(self, cam, now):
+        """returns where cam's photo is in the latest set, if it's fresh enough to reuse"""
+        if cam not in self.latest_cams:
+            return None
+        latest_num = self.latest_cams.index(cam)
+        renditions = self.latest[0]
+        if any(len(renditions.get(rendition, [])) <= latest_num for rendition in RENDITIONS):
+            return None
+        encoded_at = self.encoded_at.get(cam)
+        if encoded_at is None or now - encoded_at >= config.CHANGE_MAX_REUSE:
+            return None
+        return latest_num
+
+    def _encode_images(self, reuse=None):
+        """jpeg-encode each rendition of our images in memory, ready to upload
+
+        reuse maps an image_num to where its cam's last photo is in the
+        latest set; those keep the filenames and bytes of that photo,
+        which is already uploaded.
+        """
+        if reuse is None:
+            reuse = {}
         self.image_filename_array = []
-        logging.debug("Camera:write_images()")
+        self.image_data_array = []
+        renditions = {rendition: [] for rendition in RENDITIONS}
+        last_renditions, last_images = self.latest
+        logging.debug("Camera:encode_images()")
         for image_num in range(len(self.image_array)):
-            filename = config.IMAGE_FILE_BASE + '.' + str(uuid.uuid4()) + '.' + str(image_num) + config.IMAGE_FILE_POSTFIX
-            self.image_filename_array.append(filename)
-            logging.debug("Camera:Image filename:%s", filename)
-            cv.imwrite(filename, self.image_array[image_num])
+            if image_num in reuse:
+                for rendition in RENDITIONS:
+                    filename = last_renditions[rendition][reuse[image_num]]
+                    self.image_filename_array.append(filename)
+                    self.image_data_array.append(last_images[filename])
+                    renditions[rendition].append(filename)
+                continue
+            if image_num < len(self.image_cams):
+                image = self.image_array[image_num]
+                if image is None or image is self.noimage:
+                    # never stand a placeholder in for a real photo
+                    self.encoded_at.pop(self.image_cams[image_num], None)
+                else:
+                    self.encoded_at[self.image_cams[image_num]] = clock.time()
+            base = config.IMAGE_FILE_BASE + '.' + str(uuid.uuid4()) + '.' + str(image_num)
+            for rendition in RENDITIONS:
+                if rendition == "full":
+                    filename = base + config.IMAGE_FILE_POSTFIX
+                else:
+                    filename = base + '.' + rendition + config.IMAGE_FILE_POSTFIX
+                logging.debug("Camera:Image filename:%s", filename)
+                data = self._encode_rendition(image_num, self.image_array[image_num], rendition)
+                if data is None:
+                    logging.warning("Camera:Failed to encode photo")
+                    data = b''
+                self.image_filename_array.append(filename)
+                self.image_data_array.append(data)
+                renditions[rendition].append(filename)
+        self.renditions = renditions
+        self.latest_cams = list(self.image_cams)
+        self.previous = self.latest
+        self.latest = (renditions, dict(zip(self.image_filename_array, self.image_data_array)))
+
+    def latest_image(self, image_num, rendition="full"):
+        """returns (filename, jpeg bytes) of a cam's newest photo, or None"""
+        renditions, images = self.latest
+        filenames = renditions.get(rendition, [])
+        if not 0 <= image_num < len(filenames):
+            return None
+        return filenames[image_num], images[filenames[image_num]]
+
+    def image_by_name(self, filename):
+        """returns the jpeg bytes of one of our two newest sets, or None"""
+        for _, images in (self.latest, self.previous):
+            if filename in images:
+                return images[filename]
+        return None
+
+    def live_frames(self, image_num, fps=None, width=None, quality=None):
+        """yields jpeg frames from one cam, at most fps a second
+
+        The cam is held open in its grabber while anyone is watching, and
+        closed CAMERA_IDLE_TIMEOUT secs after the last viewer leaves. Stops
+        if the cam stops giving frames.
+        """
+        fps = config.MJPEG_FPS if fps is None else fps
+        width = config.MJPEG_WIDTH if width is None else width
+        quality = config.MJPEG_QUALITY if quality is None else quality
+        self._wait_for_discovery()
+        if not 0 <= image_num < len(self.cam_num_array):
+            return
+        # don't grab the cam out from under a cold capture
+        with self.capture_lock:
+            self._make_grabbers()
+            grabber = self.grabbers[image_num].start()
+        interval = 1.0 / fps
+        after = 0
+        while True:
+            started = time.time()
+            frame = grabber.snapshot(after)
+            if frame is None:
+                return
+            after = started
+            # baseline jpeg: quicker to make, and every browser shows it
+            data = encode_jpeg(resize_to_width(frame, width), quality, progressive=False, optimize=False)
+            if data:
+                metrics.inc("mjpeg_frames_total")
+                yield data
+            time.sleep(max(0, interval - (time.time() - started)))
+
+    def grab_frames(self, image_num, count, width, gap=0):
+        """returns up to count fresh grayscale frames from one cam, width px across
+
+        For a quick look rather than a photo: the cam is held open in its
+        grabber, as for a live view, and the camlight is on throughout.
+        Frames are at least gap secs apart.
+        """
+        self._wait_for_discovery()
+        if not 0 <= image_num < len(self.cam_num_array):
+            return []
+        frames = []
+        with self.capture_lock:
+            self._make_grabbers()
+            grabber = self.grabbers[image_num].start()
+            self.turn_on_camlight()
+            try:
+                with metrics.stage("camlight_wait"):
+                    clock.sleep(0.5)
+                after = time.time()
+                for i in range(count):
+                    frame = grabber.snapshot(after)
+                    if frame is None:
+                        break
+                    after = time.time() + gap
+                    frames.append(resize_to_width(self._filter_image(frame), width))
+            finally:
+                self.turn_off_camlight()
+        return frames
+
+    def _write_images(self):
+        """keep a copy of the encoded images on disk"""
+        logging.debug("Camera:write_images()")
+        for filename, data in zip(self.image_filename_array, self.image_data_array):
+            try:
+                with open(filename, 'wb') as file:
+                    file.write(data)
+            except:
+                logging.warning("Camera:Failed to write %s", filename)
 
     def _upload_images(self):
         logging.info("Camera:Uploading images")
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        try:
-            with pysftp.Connection(host=config.SFTP_SERVER,
-                                   username=config.SFTP_USER,
-                                   password=config.SFTP_PASSWORD,
-                                   log=config.SFTP_LOG,
-                                   cnopts=cnopts) as sftp:
-                with sftp.cd(config.SFTP_IMAGE_DIR):
-                    # delete existing files
-                    logging.debug("Camera:deleting old files via sftp")
-                    for file in sftp.listdir():
-                        sftp.remove(file)
-                    # upload files
-                    logging.debug("Camera:Uploading files via sftp")
-                    for filename in self.image_filename_array:
-                        sftp.put(filename)
-            # let's wait a bit to make sure images get uploaded
-            sleep(5)
-        except:
+        self.images_synced = self.image_sync.sync(list(zip(self.image_filename_array, self.image_data_array)))
+        if not self.images_synced:
             logging.warning("Camera:Failed to upload photos")
-
-    def _cleanup_images(self):
-        logging.info("Camera:Cleaning up local image files")
-        for file in os.listdir(config.IMAGE_DIR):
-            if not file.endswith(config.IMAGE_FILE_POSTFIX):
-                continue
-            os.remove(os.path.join(config.IMAGE_DIR, file))
+        return self.images_synced
 
     def show_images(self):
         for image_num in range(config.ACTIVE_CAMS):
             cv.imshow("Test Image", self.image_array[image_num])
 
-    def take_and_upload_images(self):
+    def take_and_upload_images(self, force=False, max_age=None):
+        """take and upload photos, or reuse ones taken in the last max_age secs
+
+        Returns a dict of rendition name ("full", "mms", "thumb") to the
+        list of filenames, one per cam (uploaded if REMOTE_UPLOAD).
+
+        Callers that arrive while a capture is under way wait for it and
+        share its photos. With force, only a capture started after the
+        call is good enough. A cam whose view hasn't changed since its
+        last photo hands back that photo, so it isn't encoded or
+        uploaded again.
+        """
         logging.debug("Camera:take_and_upload_images()")
-        self._take_all_images()
-        self._write_images()
-        self._upload_images()
-        self._cleanup_images()
-        return self.image_filename_array
+        requested = clock.time()
+        if max_age is None:
+            max_age = config.PHOTO_CACHE_TTL
+        with self.capture_lock:
+            if self.capture_started is not None:
+                age = requested - self.capture_started
+                if age <= 0 or (not force and age <= max_age):
+                    logging.info("Camera:Reusing photos from %.0fs ago", max(0, age))
+                    metrics.inc("photo_cache_total", result="hit")
+                    return self._copy_renditions()
+            metrics.inc("photo_cache_total", result="miss")
+            started = clock.time()
+            with metrics.stage("capture"):
+                self._take_all_images()
+            reuse = self._detect_changes()
+            with metrics.stage("encode"):
+                self._encode_images(reuse)
+            if config.ARCHIVE_IMAGES:
+                with metrics.stage("archive"):
+                    self._write_images()
+            if config.REMOTE_UPLOAD:
+                if reuse and len(reuse) == len(self.image_array) and self.images_synced:
+                    # every photo is one already up there
+                    logging.info("Camera:No new photos to upload")
+                else:
+                    with metrics.stage("image_upload"):
+                        self._upload_images()
+            self.capture_started = started
+            return self._copy_renditions()
+
+    def _copy_renditions(self):
+        return {rendition: list(filenames) for rendition, filenames in self.renditions.items()}
 
     def turn_on_camlight(self):
         logging.info("Camera:Turning on camlight")
@@ -188,6 +585,7 @@ class Camera(object):
         logging.debug("Camera:Camlight off")
 
     def report(self):
+        self._wait_for_discovery()
         if config.ACTIVE_CAMS == 0:
             text = "I have no camera watching. "
         if config.ACTIVE_CAMS == 1:
@@ -201,7 +599,7 @@ class Camera(object):
 def main():
     import sys
     logging.basicConfig(
-        filename=sys.stderr,
+        stream=sys.stderr,
         encoding='utf-8',
         format='%(asctime)s %(levelname)s:%(message)s',
         level=logging.DEBUG
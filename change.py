@@ -0,0 +1,109 @@
+# change.py - change detection for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import os
+from collections import namedtuple
+from lazyimport import lazy_import
+import clock
+import logging
+
+cv = lazy_import("cv2")
+np = lazy_import("numpy")
+
+# what check() found: fraction is the share of the watched area that
+# changed, and when is a local datetime
+Change = namedtuple("Change", ["cam", "fraction", "changed", "when"])
+
+
+def shrink(image, width):
+    """returns image as float32 grayscale, width px across"""
+    if image.ndim == 3:
+        image = cv.cvtColor(image, cv.COLOR_BGR2GRAY)
+    h, w = image.shape[:2]
+    size = (width, max(1, round(h * width / w)))
+    return cv.resize(image, size, interpolation=cv.INTER_AREA).astype(np.float32)
+
+def changed_fraction(image, background, threshold, mask=None):
+    """returns the share of pixels (under mask) more than threshold off background"""
+    diff = image - background
+    if mask is not None:
+        diff = diff[mask]
+    # dusk and the cam's auto exposure shift the whole frame at once
+    diff -= np.median(diff)
+    return float(np.count_nonzero(np.abs(diff) > threshold)) / diff.size
+
+def load_mask(path, shape):
+    """returns a bool array of shape, True where the mask image is white
+
+    None (watch everything) if there's no usable mask at path.
+    """
+    if not path or not os.path.isfile(path):
+        return None
+    mask = cv.imread(path, cv.IMREAD_GRAYSCALE)
+    if mask is None:
+        logging.warning("Change:Failed to read mask %s", path)
+        return None
+    mask = cv.resize(mask, (shape[1], shape[0]), interpolation=cv.INTER_AREA) > 127
+    if not mask.any():
+        logging.warning("Change:Mask %s hides everything, ignoring it", path)
+        return None
+    return mask
+
+
+class ChangeDetector(object):
+    """tells whether a cam's view has changed, one photo to the next
+
+    Each frame is shrunk to width px of grayscale and compared with a
+    running average of that cam's earlier frames. A pixel has changed if
+    it is more than threshold gray levels off that background, once any
+    overall brightening or dimming is taken out; the frame has changed
+    if more than min_fraction of the watched area did. The watched area
+    is the white part of the cam's mask, if it has one.
+
+    At 160px across that's some 20k pixels, which numpy gets through in
+    well under a millisecond on a Pi; the shrink costs a bit more.
+    """
+
+    def __init__(self, width=None, threshold=None, min_fraction=None, alpha=None, mask_file=None):
+        self.width = config.CHANGE_WIDTH if width is None else width
+        self.threshold = config.CHANGE_THRESHOLD if threshold is None else threshold
+        self.min_fraction = config.CHANGE_MIN_FRACTION if min_fraction is None else min_fraction
+        self.alpha = config.CHANGE_BG_ALPHA if alpha is None else alpha
+        self.mask_file = config.CHANGE_MASK_FILE if mask_file is None else mask_file
+        self.backgrounds = {}   # cam -> float32 array
+        self.masks = {}         # (cam, shape) -> bool array, or None for all
+
+    def _mask(self, cam, shape):
+        key = (cam, shape)
+        if key not in self.masks:
+            self.masks[key] = load_mask(self.mask_file.format(cam=cam), shape)
+        return self.masks[key]
+
+    def check(self, cam, image):
+        """compare a frame with the cam's background; returns a Change
+
+        Returns None if there's no frame, or no background to compare
+        with yet (the first frame, or the frame size changed).
+        """
+        if image is None:
+            return None
+        small = shrink(image, self.width)
+        background = self.backgrounds.get(cam)
+        if background is None or background.shape != small.shape:
+            self.backgrounds[cam] = small
+            return None
+        fraction = changed_fraction(small, background, self.threshold, self._mask(cam, small.shape))
+        # let slow changes (shadows, bedding kicked about) fade into
+        # the background
+        background += self.alpha * (small - background)
+        return Change(cam, fraction, fraction >= self.min_fraction, clock.now())
+
+    def reset(self, cam=None):
+        """forget the background of one cam, or of all of them"""
+        if cam is None:
+            self.backgrounds.clear()
+        else:
+            self.backgrounds.pop(cam, None)
@@ -8,9 +8,20 @@ from comms import Comms
 from light import Light
 from door import Door
 from camera import Camera
-from time import sleep
-from streamtologger import StreamToLogger
+from scheduler import Scheduler
+from commands import CommandRegistry
+from webhook import WebhookReceiver
+from localserver import LocalServer
+import vision
+import logsetup
+import clock
+import metrics
+import sftpsession
+import planner
+import os
 import sys
+import time
+import subprocess
 import logging
 import pprint
 
@@ -35,107 +46,353 @@ import pprint
 
 class Chickenrobot(object):
     """controller class for a coop door and cam controller"""
-    def __init__(self):
+    def __init__(self, twilio_client=None, capture_factory=None, resume_door=True):
         #
         # instantiate all our classes
-        self.comms = Comms(config.ORIGIN_NUM, config.TARGET_NUMS)
-        self.light = Light(config.CITY_NAME, config.LATITUDE, config.LONGITUDE, config.SUNRISE_DELAY, config.SUNSET_DELAY)
-        self.door = Door(config.REVS)
-        self.camera = Camera(config.MAX_HORZ, config.MAX_VERT)
+        # (a simulation passes in fake twilio and cams; see simulation.py)
+        # how long each part took to set up, for --profile-startup
+        self.startup_times = []
+        # before the door: resuming an interrupted move may finish, and
+        # hand its report to the scheduler, before __init__ is done
+        self.scheduler = Scheduler(config.SCHEDULER_MAX_SLEEP)
+        self.commands = CommandRegistry()
+        self._register_commands()
+        self.comms = self._init_part("comms", lambda: Comms(
+            config.ORIGIN_NUM, config.TARGET_NUMS, self.commands, twilio_client))
+        self.light = self._init_part("light", lambda: Light(
+            config.CITY_NAME, config.LATITUDE, config.LONGITUDE, config.SUNRISE_DELAY, config.SUNSET_DELAY))
+        self.door = self._init_part("door", lambda: Door(
+            config.REVS, on_move_done=self._door_move_done, resume_move=resume_door))
+        # who asked for the current door move (None if it was automatic)
+        self.move_requester = None
+        self.camera = self._init_part("camera", lambda: Camera(
+            config.MAX_HORZ, config.MAX_VERT, capture_factory, on_change=self._camera_changed))
+        # the last change a cam saw, and when we last texted about one
+        self.activity = None
+        self.last_alert = None
+        # looks through the doorway before an automatic close
+        self.vision = vision.VisionWorker() if config.VISION_ENABLED else None
+        # automatic closes held off so far for something in the doorway
+        self.close_holds = 0
+        self.webhook = None
+        if config.COMMAND_MODE == "webhook":
+            self._start_webhook()
+        self.local_server = None
+        if config.LOCAL_SERVER_PORT:
+            self._start_local_server()
+
+    def _init_part(self, name, make):
+        start = time.perf_counter()
+        part = make()
+        self.startup_times.append((name, time.perf_counter() - start))
+        return part
+
+    def _register_commands(self):
+        """the sms commands we understand, in order of precedence"""
+        self.commands.register("help", self.send_help)
+        self.commands.register("photo", lambda num, args: self.send_photos(num, "new" in args),
+                               aliases=["image", "picture"])
+        self.commands.register("close", lambda num, args: self.move_door_manual(self.door.close_door_manual, num))
+        self.commands.register("open", lambda num, args: self.move_door_manual(self.door.open_door_manual, num))
+        self.commands.register("stop", lambda num, args: self.comms.send_text(self.door.stop_door(), num))
+        self.commands.register("status", lambda num, args: self.send_report_and_photos(num, "new" in args),
+                               aliases=["report"])
+        self.commands.register("door", lambda num, args: self.comms.send_text(self.door.report(), num))
+        self.commands.register("sun", lambda num, args: self.comms.send_text(self.light.report(), num),
+                               aliases=["light"])
+        self.commands.register("cam", lambda num, args: self.comms.send_text(self.camera.report(), num))
+        self.commands.set_default(self.send_help)
+
+    def _start_webhook(self):
+        """listen for twilio's sms webhook; fall back to polling if we can't"""
+        if not config.WEBHOOK_URL:
+            # every request would fail the signature check, and we'd
+            # never hear a command
+            logging.error("Robot:WEBHOOK_URL isn't set, polling instead of using the webhook")
+            return
+        try:
+            self.webhook = WebhookReceiver(
+                config.WEBHOOK_PORT, config.WEBHOOK_URL, config.TWILIO_AUTH_TOKEN,
+                config.TARGET_NUMS, self.comms.parse_command,
+                on_command=lambda: self.scheduler.wake("commands")).start()
+        except:
+            logging.exception("Robot:Failed to start webhook, polling instead")
+            self.webhook = None
+
+    def _start_local_server(self):
+        """serve status and photos on the LAN; carry on without if we can't"""
+        try:
+            self.local_server = LocalServer(self.camera, self.comms.status_page).start()
+        except:
+            logging.exception("Robot:Failed to start local server")
+            self.local_server = None
 
     def on_duty(self):
-        while(1):
-            #
-            # Should the door be closed?
-            #
-            # Note: We don't test here if door is already closed
-            # (door.is_closed()), because though it may take no action
-            # with the doors, it might have to reset AUTO/MANUAL mode
-            if self.light.is_dark():
-                result = self.door.close_door_auto()
-                # It will only return something if it moved the doors
-                if result:
-                    logging.info("Robot:Door status:%s", result)
-                    # self.comms.send_text(result)
-                    self.send_report_and_photos()
-            #
-            # Should the door be open?
-            #
-            # Note: We don't test here if door is already open
-            # (door.is_open()), because though it may take no action
-            # with the doors, it might have to reset AUTO/MANUAL mode
-            elif self.light.is_light():
-                result = self.door.open_door_auto()
-                # It will only return something if it moved the doors
-                if result:
-                    logging.info("Robot:Door status:%s", result)
-                    # self.comms.send_text(result)
-                    self.send_report_and_photos()
-            #
-            # Check for messages
-            #
+        """hand our recurring jobs to the scheduler and run it"""
+        self.scheduler.schedule("door", clock.time(), self.check_door)
+        self.scheduler.schedule("commands", clock.time(), self.check_commands)
+        if config.REPORT_INTERVAL:
+            self.scheduler.schedule_in("report", config.REPORT_INTERVAL, self.periodic_report)
+        if config.WATCH_INTERVAL:
+            self.scheduler.schedule_in("watch", config.WATCH_INTERVAL, self.watch)
+        # counting the cams is slow; let the door loop get going first
+        self.camera.discover()
+        if self.vision:
+            self.vision.start()
+        self.scheduler.run()
+
+    def check_door(self):
+        """open or close the doors if needed; returns when to check next"""
+        #
+        # Should the door be closed?
+        #
+        # Note: We don't test here if door is already closed
+        # (door.is_closed()), because though it may take no action
+        # with the doors, it might have to reset AUTO/MANUAL mode
+        if self.light.is_dark():
+            if not self.doorway_clear():
+                # look again in a while, rather than at the next transition
+                return clock.time() + config.VISION_RETRY_DELAY
+            result = self.door.close_door_auto()
+            # It will only return something if it moved the doors
+            if result:
+                logging.info("Robot:Door status:%s", result)
+                # we report once the move is done (see door_moved)
+                self.move_requester = None
+        #
+        # Should the door be open?
+        #
+        # Note: We don't test here if door is already open
+        # (door.is_open()), because though it may take no action
+        # with the doors, it might have to reset AUTO/MANUAL mode
+        elif self.light.is_light():
+            result = self.door.open_door_auto()
+            # It will only return something if it moved the doors
+            if result:
+                logging.info("Robot:Door status:%s", result)
+                # we report once the move is done (see door_moved)
+                self.move_requester = None
+        return self.next_transition()
+
+    def doorway_clear(self):
+        """look through the doorway before an automatic close; False to hold off"""
+        if self.vision is None or not self.door.will_close_auto():
+            self.close_holds = 0
+            return True
+        frames = self.camera.grab_frames(config.VISION_CAM, config.VISION_FRAMES,
+                                         config.VISION_WIDTH, config.VISION_FRAME_GAP)
+        verdict = self.vision.check(frames)
+        if verdict.result in (vision.CLEAR, vision.UNKNOWN):
+            # not knowing is no reason to leave the coop open all night
+            self.close_holds = 0
+            return True
+        self.close_holds += 1
+        if self.close_holds > config.VISION_MAX_RETRIES:
+            logging.warning("Robot:Doorway still %s, closing anyway", verdict.result)
+            self.comms.send_text("Something is still in the doorway, but it's late, "
+                                 "so I'm closing the doors anyway. ")
+            if verdict.result == vision.OBSTRUCTED:
+                # nothing has moved all this time, so the doorway most
+                # likely just looks different now; don't hold every night
+                self.vision.relearn(frames)
+            self.close_holds = 0
+            return True
+        logging.info("Robot:Doorway %s, holding the doors open", verdict.result)
+        if self.close_holds == 1:
+            what = "an animal" if verdict.result == vision.ANIMAL else "something"
+            self.comms.send_text(f"I see {what} in the doorway, so I'm waiting to close the doors. ")
+        return False
+
+    def next_transition(self):
+        """returns the epoch time of the next open or close transition"""
+        return self.light.next_transition().when.timestamp()
+
+    def check_commands(self):
+        """check for messages and handle them; returns when to check next"""
+        if self.webhook:
+            command_list = self.webhook.get_commands()
+        else:
             command_list = self.comms.check_for_commands()
-            # print("command list:", command_list)
+        # print("command list:", command_list)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
             logging.debug("Robot:Received from Comms:Command list:%s", pprint.pformat(command_list, indent=4))
-            if command_list:
-                for request_num, cmd in command_list:
-                    logging.info("Robot:Handling command from %s:%s ", request_num, cmd)
-                    if cmd == "photo" or cmd == "image" or cmd == "picture":
-                        self.send_photos(request_num)
-                    elif cmd == "close":
-                        self.comms.send_text(self.door.close_door_manual(), request_num)
-                    elif cmd == "open":
-                        self.comms.send_text(self.door.open_door_manual(), request_num)
-                    elif cmd == "status" or cmd == "report":
-                        self.send_report_and_photos(request_num)
-                    elif cmd == "door":
-                        self.comms.send_text(self.door.report(), request_num)
-                    elif cmd == "sun" or cmd == "light":
-                        self.comms.send_text(self.light.report(), request_num)
-                    elif cmd == "cam":
-                        self.comms.send_text(self.camera.report(), request_num)
-                    else:
-                        txt = "Hi! I'm on duty. Helpful commands are status, photo, open, close, doors, sunset, sunrise, cameras."
-                        self.comms.send_text(txt, request_num)
-            sleep(5)
-                # print('.')
+        if command_list:
+            for request_num, cmd, args in command_list:
+                logging.info("Robot:Handling command from %s:%s ", request_num, cmd)
+                metrics.inc("commands_total", command=cmd or "none")
+                with metrics.timed("command_seconds", command=cmd or "none"):
+                    self.commands.dispatch(cmd, request_num, args)
+            # a manual open/close may need the door logic to reset
+            # AUTO/MANUAL mode, so let it have a look right away
+            self.scheduler.wake("door")
+        if self.webhook:
+            # the webhook wakes us when something arrives
+            return clock.time() + config.SCHEDULER_MAX_SLEEP
+        return clock.time() + config.COMMAND_POLL_INTERVAL
+
+    def move_door_manual(self, door_action, request_num):
+        moves = self.door.move_count
+        result = door_action()
+        # a short move can be over before we look, so check whether one
+        # was started as well as whether one is running
+        if self.door.move_count != moves or self.door.actuator.is_busy():
+            # tell them when it's done
+            self.move_requester = request_num
+        self.comms.send_text(result, request_num)
+
+    def _door_move_done(self, state):
+        """called on the door's actuator thread when a move finishes"""
+        # hand the reporting back to the scheduler thread
+        self.scheduler.schedule("door_moved", clock.time(), self.door_moved)
+
+    def door_moved(self):
+        """report on a finished door move"""
+        if self.move_requester:
+            self.comms.send_text(self.door.report(), self.move_requester)
+        else:
+            logging.info("Robot:Door status:%s", self.door.report())
+            # the door just moved, so older photos are out of date
+            self.send_report_and_photos(force=True)
+        self.move_requester = None
+        # the door logic may have more to do now the move is over
+        self.scheduler.wake("door")
+        return None
+
+    def periodic_report(self):
+        self.send_report_and_photos()
+        return clock.time() + config.REPORT_INTERVAL
+
+    def watch(self):
+        """take photos just to see if anything moved; returns when to look next"""
+        self.camera.take_and_upload_images(force=True)
+        return clock.time() + config.WATCH_INTERVAL
+
+    def _camera_changed(self, change):
+        """called by the camera, mid-capture, when a cam's view changes"""
+        self.activity = change
+        if not config.ACTIVITY_ALERT_INTERVAL:
+            return
+        if self.last_alert is not None and clock.time() - self.last_alert < config.ACTIVITY_ALERT_INTERVAL:
+            return
+        self.last_alert = clock.time()
+        # the photos are still being taken; send them once they're done
+        self.scheduler.schedule("activity", clock.time(), self.send_activity_alert)
+
+    def send_activity_alert(self):
+        # these come from the cache, since they were just taken
+        renditions = self.camera.take_and_upload_images()
+        self.comms.send_text_and_photos(self.activity_report() + "Here's photos of the coop. ", renditions)
+        return None
+
+    def activity_report(self):
+        if self.activity is None:
+            return ""
+        when = self.activity.when.strftime(config.TIME_FORMAT)
+        return f"I saw something move on camera {self.activity.cam + 1} at {when}. "
 
     def report(self):
         msg_text = ""
         msg_text += "Hi! I'm on duty. "
         msg_text += self.door.report()
         msg_text += self.camera.report()
+        msg_text += self.activity_report()
         msg_text += self.light.report()
         return(msg_text)
 
+    def send_help(self, passed_num=None, args=None):
+        names = [name for name in self.commands.names() if name != "help"]
+        txt = "Hi! I'm on duty. Helpful commands are " + ", ".join(names) + "."
+        self.comms.send_text(txt, passed_num)
+
     def send_report(self, passed_num=None):
         status = self.report()
         self.comms.send_text(status, passed_num)
 
-    def send_photos(self, passed_num=None):
-        filename_array = self.camera.take_and_upload_images()
-        self.comms.send_text_and_photos("Here's photos of the coop. ", filename_array, passed_num)
+    def send_photos(self, passed_num=None, force=False):
+        renditions = self.camera.take_and_upload_images(force)
+        self.comms.send_text_and_photos("Here's photos of the coop. ", renditions, passed_num)
 
-    def send_report_and_photos(self, passed_num=None):
+    def send_report_and_photos(self, passed_num=None, force=False):
         status_text = self.report()
         self.comms.send_text(status_text, passed_num)
-        filename_array = self.camera.take_and_upload_images()
+        renditions = self.camera.take_and_upload_images(force)
         image_text = "Here's photos of the coop. "
-        self.comms.send_text_and_photos(image_text, filename_array, passed_num)
-        self.comms.upload_status(status_text, image_text, filename_array)
+        self.comms.send_text_and_photos(image_text, renditions, passed_num)
+        self.comms.upload_status(status_text, image_text, renditions)
+
+# the modules worth reporting import times for
+PROFILE_MODULES = ["chickenrobot", "config", "comms", "light", "door", "camera", "scheduler",
+                   "commands", "webhook", "localserver", "status", "change", "vision", "metrics",
+                   "logsetup", "motion", "planner", "journal", "grabber", "imagesync", "sftpsession",
+                   "cv2", "numpy", "twilio", "pysftp", "paramiko", "suntime", "dateutil", "dotenv",
+                   "RPi.GPIO"]
+
+def _import_times():
+    """returns [(module, cumulative secs)] for importing chickenrobot afresh"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import chickenrobot"],
+                            capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        if name in PROFILE_MODULES and name not in times:
+            times[name] = int(parts[1]) / 1e6
+    return sorted(times.items(), key=lambda item: item[1], reverse=True)
+
+def profile_startup():
+    """report where startup time goes, without going on duty"""
+    print("Imports (cumulative, in a fresh interpreter):")
+    for name, secs in _import_times():
+        print(f"  {name:16} {secs * 1000:8.1f}ms")
+    # time the parts, not a robot: no servers or vision worker, and
+    # the door stays where it is, even part way through a move
+    config.COMMAND_MODE = "poll"
+    config.LOCAL_SERVER_PORT = 0
+    config.VISION_ENABLED = False
+    start = time.perf_counter()
+    chickenrobot = Chickenrobot(resume_door=False)
+    ready = time.perf_counter() - start
+    print("Init:")
+    for name, secs in chickenrobot.startup_times:
+        print(f"  {name:16} {secs * 1000:8.1f}ms")
+    print(f"  {'total':16} {ready * 1000:8.1f}ms")
+    start = time.perf_counter()
+    chickenrobot.light.is_dark()
+    chickenrobot.next_transition()
+    first_check = time.perf_counter() - start
+    print(f"First door decision {first_check * 1000:.1f}ms, "
+          f"door loop up {(ready + first_check) * 1000:.1f}ms after import")
+    print("Deferred until first use:")
+    for name, first_use in (
+            ("camera discovery", lambda: chickenrobot.camera.discover().join()),
+            ("twilio client", lambda: chickenrobot.comms.client),
+            ("sftp modules", lambda: (sftpsession.pysftp.CnOpts, sftpsession.paramiko.SFTPClient)),
+            ("motion planner", lambda: planner.np.arange)):
+        start = time.perf_counter()
+        try:
+            first_use()
+        except Exception as e:
+            print(f"  {name:16} failed:{e}")
+            continue
+        print(f"  {name:16} {(time.perf_counter() - start) * 1000:8.1f}ms")
 
 def main():
-    logging.basicConfig(
-        filename=config.LOG_FILENAME,
-        # encoding='utf-8',
-        filemode='a',
-        format='%(asctime)s %(levelname)s:%(message)s',
-        level=config.LOG_LEVEL
-    )
-    logger = logging.getLogger("chickenrobot")
-    # redirect stdout and stderr to log file
-    sys.stdout = StreamToLogger(logger,logging.INFO)
-    sys.stderr = StreamToLogger(logger,logging.ERROR)
+    if "--profile-startup" in sys.argv:
+        logging.basicConfig(
+            stream=sys.stderr,
+            encoding='utf-8',
+            format='%(asctime)s %(levelname)s:%(message)s',
+            level=logging.WARNING
+        )
+        profile_startup()
+        return
+    # log from a background thread, with stdout and stderr redirected
+    # to the log file too
+    log_listener = logsetup.start_logging()
     # logging.debug('This message should go to the log file')
     # logging.info('So should this')
     # logging.warning('And this, too')
@@ -144,6 +401,7 @@ def main():
     logging.info("Robot:I'm on duty.")
 
     # nuthin here yet
+    exporter = metrics.start()
     chickenrobot = Chickenrobot()
     try:
         chickenrobot.on_duty()
@@ -153,6 +411,12 @@ def main():
     except:
         logging.exception('Got exception on main handler')
         raise
+    finally:
+        if chickenrobot.vision:
+            chickenrobot.vision.stop()
+        if exporter is not None:
+            exporter.stop()
+        logsetup.stop_logging(log_listener)
 
 if __name__ == '__main__':
     main()
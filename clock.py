@@ -0,0 +1,95 @@
+# clock.py - swappable clock for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import time as _time
+from datetime import datetime
+from dateutil import tz
+
+# Everything that cares what time it is, or waits for time to pass, asks
+# this module rather than time/datetime directly, so a simulation can
+# swap in a SimClock and run months of days in seconds.
+
+to_zone = tz.tzlocal()
+
+
+class Clock(object):
+    """the real wall clock"""
+
+    def time(self):
+        """epoch seconds"""
+        return _time.time()
+
+    def now(self):
+        """aware local datetime"""
+        return datetime.now().astimezone(to_zone)
+
+    def sleep(self, secs):
+        _time.sleep(secs)
+
+    def wait(self, cond, timeout=None):
+        """wait on a held threading.Condition for up to timeout secs"""
+        return cond.wait(timeout)
+
+
+class SimClock(Clock):
+    """a clock that only moves when something sleeps or waits
+
+    Sleeping or waiting jumps straight to the end of the timeout, so
+    code driven by it runs as fast as the CPU allows. It assumes one
+    thread is driving time forward; work on other threads (a door move,
+    say) can hold time still until it's done with hold_while().
+    """
+
+    def __init__(self, start=None):
+        self.t = _time.time() if start is None else start
+        self.holds = []
+
+    def hold_while(self, busy):
+        """don't jump ahead in wait() while busy() is true"""
+        self.holds.append(busy)
+
+    def time(self):
+        return self.t
+
+    def now(self):
+        return datetime.fromtimestamp(self.t).astimezone(to_zone)
+
+    def sleep(self, secs):
+        if secs > 0:
+            self.t += secs
+
+    def wait(self, cond, timeout=None):
+        if any(busy() for busy in self.holds):
+            # give the other thread a moment (really) to finish; it may
+            # schedule something that is due now
+            cond.wait(0.01)
+            return True
+        if timeout is None:
+            # nothing would ever wake us in a simulation; don't hang
+            return cond.wait(0)
+        self.sleep(timeout)
+        return False
+
+
+_clock = Clock()
+
+def get_clock():
+    return _clock
+
+def set_clock(new_clock):
+    global _clock
+    _clock = new_clock
+
+def time():
+    return _clock.time()
+
+def now():
+    return _clock.now()
+
+def sleep(secs):
+    _clock.sleep(secs)
+
+def wait(cond, timeout=None):
+    return _clock.wait(cond, timeout)
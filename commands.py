@@ -0,0 +1,80 @@
+# commands.py - sms command registry for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import re
+from collections import namedtuple
+import logging
+
+Command = namedtuple("Command", ["name", "aliases", "handler", "priority"])
+
+
+class CommandRegistry(object):
+    """maps command keywords and their aliases to handlers
+
+    All aliases are compiled into one regex alternation, so a message is
+    scanned once however many commands there are. As before, keywords
+    match anywhere in the message ("photos", "sunset"), and if a message
+    holds several, the command registered first wins. The words after
+    the keyword are passed to the handler as args.
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.aliases = {}
+        self.pattern = None
+        self.default = None
+
+    def register(self, name, handler, aliases=()):
+        """register handler(request_num, args) under name and its aliases"""
+        command = Command(name, tuple(aliases), handler, len(self.commands))
+        self.commands[name] = command
+        for alias in (name,) + command.aliases:
+            self.aliases[alias.lower()] = command
+        self.pattern = None
+
+    def set_default(self, handler):
+        """handler for messages that don't match any command"""
+        self.default = handler
+
+    def _compile(self):
+        # longest first, so "photos" can't be cut short by "photo"
+        keywords = sorted(self.aliases, key=len, reverse=True)
+        self.pattern = re.compile("|".join(re.escape(k) for k in keywords))
+
+    def match(self, body):
+        """returns (command name, args) for a msg body, or ("", args)"""
+        if not self.aliases:
+            return "", []
+        if self.pattern is None:
+            self._compile()
+        body = body.lower()
+        best = None
+        for found in self.pattern.finditer(body):
+            command = self.aliases[found.group(0)]
+            if best is None or command.priority < best[0].priority:
+                best = (command, found)
+        if best is None:
+            return "", body.split()
+        command, found = best
+        args = body[found.end():].split()
+        if args and not body[found.end()].isspace():
+            # skip the rest of the word the keyword was in ("photos!")
+            args = args[1:]
+        return command.name, args
+
+    def names(self):
+        return list(self.commands)
+
+    def dispatch(self, name, request_num, args=()):
+        """run the handler for a command name"""
+        command = self.commands.get(name)
+        if command is not None:
+            handler = command.handler
+        else:
+            handler = self.default
+        if handler is None:
+            logging.warning("Commands:No handler for %s", name)
+            return None
+        return handler(request_num, list(args))
@@ -5,28 +5,23 @@
 
 import config
 import random
-from twilio.rest import Client
-import pysftp
+from concurrent.futures import ThreadPoolExecutor
+from status import StatusPage
+import clock
+import metrics
+from lazyimport import lazy_import
 import logging
 import pprint
-from datetime import datetime, timedelta
+import threading
+from datetime import timedelta
 
-# CONSTANTS
-
-COMMANDS = [
-    "help",
-    "photo",
-    "image",
-    "picture",
-    "close",
-    "open",
-    "status",
-    "report",
-    "door",
-    "sun",
-    "light",
-    "cam"
-]
+# twilio is slow to import; we bring it in with the first message
+twilio_rest = lazy_import("twilio.rest")
+twilio_http = lazy_import("twilio.http.http_client")
+twilio_exceptions = lazy_import("twilio.base.exceptions")
+# what twilio's http client raises when it can't get through
+requests_exceptions = lazy_import("requests.exceptions")
+urllib3_exceptions = lazy_import("urllib3.exceptions")
 
 logger = logging.getLogger()
 logging.getLogger('twilio.http_client').setLevel(logging.WARNING)
@@ -34,11 +29,28 @@ logging.getLogger('twilio.http_client').setLevel(logging.WARNING)
 class Comms(object):
     """Takes care of all outward communications"""
 
-    def __init__(self, origin_num, target_nums):
-        self.client = Client(config.TWILIO_ACCOUNT_SID, config.TWILIO_AUTH_TOKEN)
+    def __init__(self, origin_num, target_nums, commands=None, client=None):
+        # made on first use (see client), unless we're handed one
+        self._client = client
+        self.client_lock = threading.Lock()
+        self.status_page = StatusPage()
+        self.executor = ThreadPoolExecutor(max_workers=config.SEND_WORKERS)
         self.origin_num = origin_num
         self.target_nums = target_nums
-        self.last_fetch = datetime.now() - timedelta(minutes=60)
+        self.commands = commands
+        self.last_fetch = clock.now() - timedelta(minutes=60)
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.client_lock:
+                if self._client is None:
+                    # a pooled http client keeps the https connection to twilio
+                    # alive between messages instead of handshaking for each one
+                    self._client = twilio_rest.Client(
+                        config.TWILIO_ACCOUNT_SID, config.TWILIO_AUTH_TOKEN,
+                        http_client=twilio_http.TwilioHttpClient(pool_connections=True))
+        return self._client
 
     def random_signon(self):
         return random.choice([
@@ -111,6 +123,67 @@ class Comms(object):
             "Bless the rains, 🐓🤖"
         ])
 
+    @staticmethod
+    def _never_sent(e):
+        """True if e means the request never reached twilio"""
+        if isinstance(e, requests_exceptions.ConnectTimeout):
+            return True
+        if isinstance(e, requests_exceptions.ConnectionError) and e.args:
+            # refused, unreachable or no dns; a reset mid-reply isn't this
+            reason = getattr(e.args[0], "reason", e.args[0])
+            return isinstance(reason, (urllib3_exceptions.NewConnectionError,
+                                       urllib3_exceptions.ConnectTimeoutError))
+        return False
+
+    def _send_one(self, phone_number, **kwargs):
+        """send one message, retrying failures we know didn't send it
+
+        Creating a message isn't idempotent: after a timeout or a 5xx,
+        twilio may well have queued it already, so we only retry when
+        the request never got there, or twilio said 429 (too many
+        requests, nothing queued). Anything else is logged and given up.
+        """
+        delay = config.SEND_RETRY_DELAY
+        for attempt in range(config.SEND_RETRIES + 1):
+            try:
+                with metrics.stage("send_mms" if kwargs.get("media_url") else "send_sms"):
+                    self.client.messages.create(
+                        from_ = self.origin_num,
+                        to = phone_number,
+                        **kwargs
+                    )
+                metrics.inc("messages_sent_total", result="sent")
+                return True
+            except twilio_exceptions.TwilioRestException as e:
+                if e.status != 429:
+                    # a 4xx (bad number, unsubscribed) won't get better by
+                    # retrying, and after a 5xx it may have gone anyway
+                    logging.warning("Comms:Twilio answered %s to msg to %s:%s", e.status, phone_number, e.msg)
+                    metrics.inc("messages_sent_total", result="refused" if e.status < 500 else "failed")
+                    return False
+            except Exception as e:
+                if not self._never_sent(e):
+                    logging.warning("Comms:Msg to %s may not have been sent, not retrying:%s", phone_number, e)
+                    metrics.inc("messages_sent_total", result="failed")
+                    return False
+            if attempt < config.SEND_RETRIES:
+                logging.info("Comms:Retrying msg to %s in %ss", phone_number, delay)
+                clock.sleep(delay)
+                delay *= 2
+        logging.warning("Comms:Failed to send msg to %s:%s", phone_number, kwargs.get("body"))
+        metrics.inc("messages_sent_total", result="failed")
+        return False
+
+    def _broadcast(self, target_nums, **kwargs):
+        """send a message to every number at once; returns {number: sent}"""
+        futures = {}
+        for phone_number in target_nums:
+            futures[phone_number] = self.executor.submit(self._send_one, phone_number, **kwargs)
+        results = {phone_number: future.result() for phone_number, future in futures.items()}
+        sent = sum(results.values())
+        logging.info("Comms:Sent %s of %s msgs", sent, len(results))
+        return results
+
     def send_text(self, msg_text, passed_num=None):
         if passed_num:
             my_target_nums = [passed_num]
@@ -119,75 +192,55 @@ class Comms(object):
         msg_text = self.random_signon() + msg_text + "\n" + self.random_signoff()
         for phone_number in my_target_nums:
             logging.info("Comms:Sending msg to %s", phone_number)
-            try:
-                message = self.client.messages.create(
-                    body = msg_text,
-                    from_ = self.origin_num,
-                    to = phone_number
-                )
-            except:
-                logging.warning("Comms:Failed to send msg to %s:%s", phone_number, msg_text)
+        return self._broadcast(my_target_nums, body=msg_text)
+
+    def _pick_rendition(self, renditions, rendition):
+        """returns the filenames for one rendition, falling back to full size"""
+        if isinstance(renditions, dict):
+            return renditions.get(rendition) or renditions.get("full", [])
+        # a plain list of filenames
+        return renditions
 
-    def send_text_and_photos(self, msg_text, filename_array, passed_num=None):
+    def send_text_and_photos(self, msg_text, renditions, passed_num=None):
+        filename_array = self._pick_rendition(renditions, "mms")
         if passed_num:
             my_target_nums = [passed_num]
         else:
             my_target_nums = self.target_nums
         if not len(filename_array):
             msg_text = "No cameras available, so no photos."
-        msg_text = self.random_signon() + msg_text + "\n" + self.random_signoff()
         image_array = []
-        for filename in filename_array:
-            image_url = config.IMAGE_URL_BASE + filename
-            logging.debug("Comms:Image URL:%s", image_url)
-            image_array.append(image_url)
+        if config.REMOTE_UPLOAD:
+            for filename in filename_array:
+                image_url = config.IMAGE_URL_BASE + filename
+                logging.debug("Comms:Image URL:%s", image_url)
+                image_array.append(image_url)
+        elif len(filename_array) and config.LOCAL_URL_BASE:
+            # twilio can only fetch media from a public url, and we
+            # didn't upload any; send a link to the local server instead
+            msg_text += config.LOCAL_URL_BASE
+        msg_text = self.random_signon() + msg_text + "\n" + self.random_signoff()
         for phone_number in my_target_nums:
             logging.info("Comms:Sending photos to:%s", phone_number)
-            try:
-                message = self.client.messages.create(
-                    body = msg_text,
-                    from_ = self.origin_num,
-                    media_url=image_array,
-                    to = phone_number
-                )
-            except:
-                logging.warning("Comms:Failed to send msg to %s:%s", phone_number, msg_text)
+        return self._broadcast(my_target_nums, body=msg_text, media_url=image_array)
 
-    def upload_status(self, status_text, image_text, filename_array):
-        status_text = self.random_signon() + status_text + "\n"
-        image_text = image_text + "\n" + self.random_signoff()
-        html_text = ''
-        # add status
-        html_text += f'<div class="status"><pre style="white-space:pre-wrap;word-wrap:break-word;">{status_text}</pre></div>'
-        # add photos
-        html_text += '<div class="images">'
-        if not len(filename_array):
-            image_text = "No cameras available, so no photos."
-        for filename in filename_array:
-            image_url = config.IMAGE_URL_BASE + filename
-            html_text += f'<img src="{image_url}" style="{config.IMG_STYLE}">'
-        html_text += '</div>'
-        html_text += f'<div class="image-text"><pre>{image_text}</pre></div>'
-        # print("html text:", html_text)
-        # write status locally
-        with open(config.STATUS_FILE, 'w') as out_file:
-            out_file.write(html_text)
-        # upload status
-        logging.info("Comms:Uploading status")
-        cnopts = pysftp.CnOpts()
-        cnopts.hostkeys = None
-        try:
-            with pysftp.Connection(host=config.SFTP_SERVER,
-                                   username=config.SFTP_USER,
-                                   password=config.SFTP_PASSWORD,
-                                   log=config.SFTP_LOG,
-                                   cnopts=cnopts) as sftp:
-                with sftp.cd(config.SFTP_MAIN_DIR):
-                    # upload files
-                    logging.debug("Comms:Uploading status file via sftp")
-                    sftp.put(config.STATUS_FILE)
-        except:
-            logging.warning("Comms:Failed to upload status")
+    def upload_status(self, status_text, image_text, renditions):
+        """publish status.html and status.json; True if they were uploaded
+
+        Nothing is uploaded if only the sign-on and sign-off would change.
+        """
+        return self.status_page.publish(
+            status_text, image_text,
+            self._pick_rendition(renditions, "full"),
+            self._pick_rendition(renditions, "thumb"),
+            self._pick_rendition(renditions, "mms"),
+            signon=self.random_signon(), signoff=self.random_signoff())
+
+    def parse_command(self, body):
+        """returns (command, args) for a msg body; command is '' if none"""
+        if self.commands is None:
+            return "", body.lower().split()
+        return self.commands.match(body)
 
     def check_for_commands(self):
         """check for commands via sms and respond"""
@@ -196,12 +249,13 @@ class Comms(object):
         # We fetch the list from the Twilio API
         messages = None
         try:
-            messages = self.client.messages.list(
-                to=config.ORIGIN_NUM,
-                date_sent_after=self.last_fetch - timedelta(minutes=15)
-            )
+            with metrics.stage("twilio_poll"):
+                messages = self.client.messages.list(
+                    to=config.ORIGIN_NUM,
+                    date_sent_after=self.last_fetch - timedelta(minutes=15)
+                )
             # if successful, record the date for our next fetch
-            self.last_fetch = datetime.now()
+            self.last_fetch = clock.now()
             # and reverse it since it comes most recent first
             messages.reverse()
         except:
@@ -223,12 +277,8 @@ class Comms(object):
                     logging.warning("Comms:Failed to delete msg:sid %s", msg.sid)
                 continue
             # look for command within msg
-            cmd = ""
-            for keyword in COMMANDS:
-                if keyword in msg.body.lower():
-                    cmd = keyword
-                    break
-            command_list.append((msg.from_, cmd))
+            cmd, args = self.parse_command(msg.body)
+            command_list.append((msg.from_, cmd, args))
             logging.info("Comms:Message received from %s:%s", msg.from_, cmd)
             # delete message
             logging.debug("Comms:Deleting handled message")
@@ -236,13 +286,14 @@ class Comms(object):
                 self.client.messages(msg.sid).delete()
             except:
                 logging.warning("Comms:Failed to delete msg:sid %s", msg.sid)
-        logging.debug("Comms:Command list:%s", pprint.pformat(command_list, indent=4))
+        if logger.isEnabledFor(logging.DEBUG):
+            logging.debug("Comms:Command list:%s", pprint.pformat(command_list, indent=4))
         return command_list
 
 def main():
     import sys
     logging.basicConfig(
-        filename=sys.stderr,
+        stream=sys.stderr,
         encoding='utf-8',
         format='%(asctime)s %(levelname)s:%(message)s',
         level=logging.DEBUG
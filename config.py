@@ -12,12 +12,24 @@ if sys.platform == "darwin":
     sys.modules['RPi'] = fake_rpi.RPi     # Fake RPi
     sys.modules['RPi.GPIO'] = fake_rpi.RPi.GPIO # Fake GPIO
     # sys.modules['smbus'] = fake_rpi.smbus # Fake smbus (I2C)
-import RPi.GPIO as GPIO
 import logging
 
 # Chickenrobot class
 LOG_FILENAME = "logs/cr.log"
 LOG_LEVEL = logging.INFO
+LOG_ROTATE = "size"         # rotate the log by "size" or "time"
+LOG_MAX_BYTES = 1000000     # size rotation: bytes per log file
+LOG_ROTATE_WHEN = "midnight"    # time rotation: when to start a new file
+LOG_BACKUPS = 5             # old log files to keep
+LOG_FLUSH_BATCH = 50        # records written between flushes while busy
+LOG_QUEUE_SIZE = 10000      # records held for the log thread before dropping
+COMMAND_POLL_INTERVAL = 5   # seconds between checks for new messages
+REPORT_INTERVAL = 0         # seconds between unprompted reports (0 = off)
+SCHEDULER_MAX_SLEEP = 300   # longest single sleep, guards against clock jumps
+METRICS_ENABLED = False     # count and time each stage (see metrics.py)
+METRICS_PORT = 9108         # serve prometheus text on /metrics here (0 = off)
+METRICS_FILE = ""           # also dump it to this file ("" = off)
+METRICS_DUMP_INTERVAL = 60  # seconds between dumps
 
 # Light class
 #
@@ -28,6 +40,7 @@ LONGITUDE = -122.0733
 SUNRISE_DELAY = 0 # minutes
 SUNSET_DELAY = 60 # minutes
 TIME_FORMAT = '%-I:%M%p'
+LIGHT_CACHE_DAYS = 4 # days of sun times to keep cached
 
 # Camera class
 #
@@ -39,6 +52,10 @@ else:
     MAX_HORZ = 1280
     MAX_VERT = 1024
 MAX_CAMS = 8
+CAPTURE_TIMEOUT = 5     # seconds to wait for a camera before using NOIMAGE_FILE
+CAMERA_WARM = False     # keep cams open in grabber threads between photos
+CAMERA_IDLE_TIMEOUT = 300   # seconds without a photo before grabbers close cams
+PHOTO_CACHE_TTL = 60    # seconds a set of uploaded photos is reused ("photo new" forces)
 ACTIVE_CAMS = 0
 
 # Local file deets
@@ -46,9 +63,21 @@ ACTIVE_CAMS = 0
 IMAGE_DIR = "images"
 IMAGE_FILE_BASE = IMAGE_DIR + "/image"
 IMAGE_FILE_POSTFIX = '.jpg'
+ARCHIVE_IMAGES = False  # also keep a copy of each photo in IMAGE_DIR
+JPEG_QUALITY = 90       # 0-100
+JPEG_PROGRESSIVE = True
+JPEG_OPTIMIZE = True    # optimized huffman tables: smaller, a little slower
+THUMB_WIDTH = 300       # status page thumbnail width (px)
+MMS_WIDTH = 800         # mms rendition width (px)
+MMS_MAX_BYTES = 300000  # byte budget for each mms image; carriers recompress bigger ones
+MMS_MIN_QUALITY = 30    # lowest jpeg quality we'll go to to meet the budget
 IMAGE_URL_BASE = 'https://modes.io/interactive/chickenrobot/'
-DOOR_STATE_FILE = "door.state"
+REMOTE_UPLOAD = True    # upload photos and the status page by sftp (mms photos need it)
+DOOR_STATE_FILE = "door.state"     # old format, read once to seed the journal
+DOOR_JOURNAL_FILE = "door.journal"
+DOOR_SNAPSHOT_FILE = "door.snapshot"
 STATUS_FILE = "status.html"
+STATUS_JSON_FILE = "status.json"   # the same status, for machines
 NOIMAGE_FILE = "image-not-available.png"
 
 # SFTP deets
@@ -59,6 +88,10 @@ SFTP_IMAGE_DIR = '/lamp0/web/vhosts/modes.io/htdocs/interactive/chickenrobot/ima
 SFTP_MAIN_DIR = '/lamp0/web/vhosts/modes.io/htdocs/interactive/chickenrobot'
 SFTP_LOG = 'logs/sftp.log'
 SFTP_PASSWORD = os.environ['SFTP_PASSWORD']
+SFTP_KEEPALIVE = 30     # seconds between ssh keepalives (0 = off)
+SFTP_MIN_BACKOFF = 5    # seconds to wait after a failed connect
+SFTP_MAX_BACKOFF = 600  # longest wait between connect attempts
+SFTP_UPLOAD_WORKERS = 2 # photos uploaded at once, each on its own sftp channel
 
 # GPIO Configs
 #
@@ -67,12 +100,22 @@ DIR_PIN = 20            # Direction GPIO pin
 STEP_PIN = 21           # Step GPIO pin
 CAMLIGHT_PIN = 19       # Activate camlight GPIO pin
 INDICATOR_PIN = 26      # Activate indicator GPIO pin
-PINOUT_SCHEME = GPIO.BCM   # Boradcom pin numbering (NOT Wiring Pin numbering)
+PINOUT_SCHEME = "BCM"    # Boradcom pin numbering (NOT Wiring Pin numbering); "BOARD" for board numbering
 
 # Door class
 #
 SPR = 200           # Steps per revolution (360/1.8) from stepper datasheet
 REVS = 10           # number of revolutions to bring door up or lower it down
+STEPPER_BACKEND = "rpigpio"     # "rpigpio" (python loop), "pigpio" (DMA waves), "gpiod" or "sim"
+GPIOD_CHIP = "gpiochip0"
+STEPPER_PROFILE = "trapezoid"   # "constant" (the old fixed speed), "trapezoid" or "scurve"
+STEPPER_START_SPEED = 100   # steps/sec to start and stop at (the old fixed speed)
+STEPPER_MAX_SPEED = 250     # steps/sec cruising speed
+STEPPER_ACCEL = 200         # steps/sec^2
+STEPPER_JERK = 1000         # steps/sec^3 (scurve only)
+DOOR_JOURNAL_INTERVAL = 0.25    # secs between position records while moving
+JOURNAL_FSYNC_BATCH = 4     # unforced records between fsyncs (the door fsyncs every record)
+JOURNAL_COMPACT_RECORDS = 1000  # records before the journal is folded into the snapshot
 
 # Comms class
 #
@@ -85,3 +128,50 @@ ORIGIN_NUM = '+18313370604'
 TARGET_NUMS = ['+18314190044', '+18312269992']
 # TARGET_NUMS = ['+18314190044']
 IMG_STYLE = "width:300px;padding:5px;"
+COMMAND_MODE = "poll"   # "poll" the twilio api, or receive a "webhook"
+WEBHOOK_PORT = 8081
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')   # public url twilio posts to (signature check)
+SEND_WORKERS = 4        # messages sent to twilio at once
+SEND_RETRIES = 3        # retries per recipient on a transient failure
+SEND_RETRY_DELAY = 1    # seconds before the first retry, doubling after
+
+# Local server (see localserver.py)
+#
+LOCAL_SERVER_PORT = 0       # e.g. 8080 to serve status, photos and live view, with no login (0 = off)
+LOCAL_SERVER_HOST = '127.0.0.1' # set to the Pi's LAN address, e.g. '192.168.1.20', to serve the LAN ('' = all)
+LOCAL_URL_BASE = ""         # e.g. 'http://chickenrobot.local:8080/', texted in place of photos without REMOTE_UPLOAD
+MJPEG_FPS = 5               # live view frames per second
+MJPEG_WIDTH = 640           # live view width (px)
+MJPEG_QUALITY = 70          # 0-100
+MJPEG_MAX_STREAMS = 4       # live viewers at once
+
+# Change detection (see change.py)
+#
+CHANGE_DETECTION = True     # reuse a cam's last photo while its view hasn't changed
+CHANGE_WIDTH = 160          # width (px) frames are shrunk to before comparing
+CHANGE_THRESHOLD = 25       # gray levels a pixel must move to count as changed
+CHANGE_MIN_FRACTION = 0.01  # share of the watched area that must change
+CHANGE_BG_ALPHA = 0.2       # how much of each new frame goes into the background (0-1)
+CHANGE_MASK_FILE = ""       # per-cam mask, e.g. "masks/cam{cam}.png" ({cam} = device number), white is watched ("" = all)
+CHANGE_MAX_REUSE = 3600     # seconds an unchanged cam's photo is reused at most
+WATCH_INTERVAL = 0          # seconds between photos taken just to look for activity (0 = off)
+ACTIVITY_ALERT_INTERVAL = 0 # text photos when a cam sees activity, at most this often (0 = off)
+
+# Vision (see vision.py)
+#
+VISION_ENABLED = False      # look through the doorway before closing it automatically
+VISION_CAM = 0              # which cam (in the order found) sees the doorway
+VISION_WIDTH = 320          # width (px) of the frames looked at
+VISION_FRAMES = 4           # frames per look
+VISION_FRAME_GAP = 0.25     # seconds between them, so movement shows
+VISION_BUDGET = 2.0         # seconds to wait for an answer before closing anyway
+VISION_THRESHOLD = 25       # gray levels a pixel must move to count
+VISION_MIN_FRACTION = 0.02  # share of the doorway that must move or differ
+VISION_MASK_FILE = ""       # doorway mask, white is the doorway ("" = whole frame)
+VISION_MODEL = ""           # optional opencv dnn detector, e.g. MobileNet-SSD .caffemodel ("" = off)
+VISION_MODEL_CONFIG = ""    # and its config, e.g. .prototxt
+VISION_ANIMAL_CLASSES = ["bird", "cat", "dog"]  # model classes that count as an animal
+VISION_CONFIDENCE = 0.5     # model confidence that counts
+VISION_RETRY_DELAY = 120    # seconds before trying to close again
+VISION_MAX_RETRIES = 10     # holds before closing anyway
+VISION_RECORD_DIR = "vision"    # where vision.py --record keeps bursts
@@ -11,20 +11,33 @@ if sys.platform == "darwin":
     sys.modules['RPi'] = fake_rpi.RPi     # Fake RPi
     sys.modules['RPi.GPIO'] = fake_rpi.RPi.GPIO # Fake GPIO
     # sys.modules['smbus'] = fake_rpi.smbus # Fake smbus (I2C)
-import RPi.GPIO as GPIO
+from lazyimport import lazy_import
+import motion
+import planner
+from actuator import Actuator
+from journal import Journal
+import metrics
 from time import sleep
+import functools
+import threading
 import os.path
+import re
 import logging
 
+GPIO = lazy_import("RPi.GPIO")
+
 # Directions
 CCW = 0    # Anti-clockwise rotation
 CW = 1       # Clockwise rotation
 # Door state
 CLOSED = 0
 OPEN = 1
+PARTIAL = 2     # stopped somewhere in between
 # Door modes
 AUTO = 0
 MANUAL = 1
+# Journal target when no move is under way
+NO_TARGET = -1
 # Indicator modes
 LIGHT_OFF = 1
 LIGHT_ON = 0
@@ -35,47 +48,104 @@ STEP_DELAY = 1 / config.SPR   # 1 second / SPR
 class Door(object):
     """class to open and close coop door and report on status"""
 
-    def __init__(self, revs):
+    def __init__(self, revs, on_move_done=None, resume_move=True):
         self.revs = revs
-        self.mode = AUTO
+        self.total_steps = revs * STEP_COUNT
+        self.journal = None
+        self._mode = AUTO
+        # state is where the doors are, or where they're headed once a
+        # move has been asked for; position is in steps from closed
         self.state = None
-        self._read_door_state()
+        self.position = 0
+        self.moving = None
+        self.move_steps = 0
+        # moves asked for so far
+        self.move_count = 0
+        self.on_move_done = on_move_done
+        self.lock = threading.RLock()
+        self.stepper = motion.get_backend(config.STEPPER_BACKEND)
+        self.actuator = Actuator("door")
+        self.journal = Journal(config.DOOR_JOURNAL_FILE, config.DOOR_SNAPSHOT_FILE)
+        resume = self._read_door_state()
         self._setup_door()
         self._setup_indicator()
         self._set_indicator(self.state)
+        if resume is not None and resume_move:
+            # we lost power or crashed part way through a move; finish it
+            logging.info("Door:Resuming interrupted move from step %s", self.position)
+            self._move_door(resume)
+        elif resume is not None:
+            logging.info("Door:Leaving interrupted move at step %s", self.position)
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, mode):
+        changed = mode != self._mode
+        self._mode = mode
+        if changed and self.journal is not None:
+            target = self.state if self.moving is not None else NO_TARGET
+            self._store_door_state(target)
 
     def _setup_door(self):
         try:
-            GPIO.setwarnings(False)
-            GPIO.setmode(config.PINOUT_SCHEME)
-            GPIO.setup(config.DIR_PIN, GPIO.OUT)
-            GPIO.setup(config.STEP_PIN, GPIO.OUT)
+            self.stepper.setup()
         except:
             logging.warning("Door:Failed to setup door (GPIO)")
 
     def _setup_indicator(self):
         try:
             GPIO.setwarnings(False)
-            GPIO.setmode(config.PINOUT_SCHEME)
+            GPIO.setmode(motion.pin_numbering())
             GPIO.setup(config.INDICATOR_PIN, GPIO.OUT)
         except:
             logging.warning("Door:Failed to setup indicator (GPIO)")
 
-    def _store_door_state(self):
-        with open(config.DOOR_STATE_FILE, 'w') as file:
-            file.write("DOOR_STATUS=" + str(self.state))
+    def _store_door_state(self, target=NO_TARGET, position=None, sync=True):
+        """journal state, mode, position and any move under way"""
+        if position is None:
+            position = self.position
+        self.journal.append([self.state, self._mode, position, target], sync)
 
     def _read_door_state(self):
-        if (os.path.isfile(config.DOOR_STATE_FILE)):
-            with open(config.DOOR_STATE_FILE, 'r') as file:
-                line = file.read()
-            try:
-                self.state = int(line.split("=")[1].strip())
-            except ValueError:
-                self.state = CLOSED
-        else:
-            self.state = CLOSED
-            self._store_door_state()
+        """recover our state; returns the target of an interrupted move, or None"""
+        record = self.journal.recover()
+        if record is not None:
+            self.state, self._mode, self.position, target = record
+            if target != NO_TARGET and self.position != self._target_position(target):
+                self.state = self._state_at(self.position)
+                return target
+            return None
+        self.state = self._read_legacy_door_state()
+        self.position = self._target_position(self.state)
+        if self.state == PARTIAL:
+            logging.warning("Door:Door was left part way; assuming half open")
+            self.position = self.total_steps // 2
+        self._store_door_state()
+        return None
+
+    def _read_legacy_door_state(self):
+        """the old single-line DOOR_STATUS=n state file, if there is one"""
+        if not os.path.isfile(config.DOOR_STATE_FILE):
+            return CLOSED
+        with open(config.DOOR_STATE_FILE, 'r') as file:
+            match = re.search(r"DOOR_STATUS\s*=\s*(\d+)", file.read())
+        if match and int(match.group(1)) in (CLOSED, OPEN, PARTIAL):
+            return int(match.group(1))
+        logging.warning("Door:Couldn't read %s; assuming closed", config.DOOR_STATE_FILE)
+        return CLOSED
+
+    def _target_position(self, state):
+        return self.total_steps if state == OPEN else 0
+
+    def _state_at(self, position):
+        if position <= 0:
+            return CLOSED
+        if position >= self.total_steps:
+            return OPEN
+        return PARTIAL
 
     def _set_indicator(self, state):
         if (state == OPEN):
@@ -92,20 +162,90 @@ class Door(object):
                 logging.warning("Door:Failed to turn off indicator (GPIO)")
 
     def _move_door(self, state):
+        """start the doors toward state on the actuator thread; returns at once
+
+        If the doors are already moving, that move stops where it is and
+        this one takes over from there, so this also reverses them.
+        """
+        with self.lock:
+            self.state = state
+            self.move_count += 1
+            self.actuator.submit(functools.partial(self._drive, state))
+
+    def _drive(self, state, cancel):
+        """runs on the actuator thread: move from wherever we are to state"""
+        with self.lock:
+            target = self._target_position(state)
+            start = self.position
+            steps = abs(target - start)
+            direction = OPEN if target > start else CLOSED
+            sign = 1 if direction == OPEN else -1
+            self.moving = direction
+            self.move_steps = steps
+            self._store_door_state(state)
+        # work out the whole pulse train first, then let the backend play it
+        move = planner.plan_move(direction, steps, STEP_DELAY)
+        done_event = threading.Event()
+        recorder = threading.Thread(target=self._record_progress,
+                                    args=(state, start, sign, done_event), daemon=True)
+        recorder.start()
         try:
-            GPIO.output(config.DIR_PIN, state)
-            for x in range(self.revs * STEP_COUNT):
-                GPIO.output(config.STEP_PIN, GPIO.HIGH)
-                sleep(STEP_DELAY)
-                GPIO.output(config.STEP_PIN, GPIO.LOW)
-                sleep(STEP_DELAY)
+            with metrics.stage("door_move"):
+                done = self.stepper.run(move, cancel)
         except:
             logging.warning("Door:Failed to operate door (GPIO)")
-        # set indicator light
-        self._set_indicator(state)
-        # record status
-        self.state = state
-        self._store_door_state()
+            done = steps
+        metrics.inc("door_steps_total", done)
+        metrics.inc("door_moves_total", direction="open" if direction == OPEN else "close",
+                    result="complete" if done == steps else "stopped")
+        done_event.set()
+        recorder.join()
+        with self.lock:
+            self.moving = None
+            self.position = start + sign * done
+            reached = self._state_at(self.position)
+            # set indicator light
+            self._set_indicator(reached)
+            superseded = self.actuator.superseded()
+            if superseded:
+                # the next move already owns self.state and will record it
+                return
+            # record status
+            self.state = reached
+            self._store_door_state()
+        logging.info("Doors:Door move finished after %s of %s steps", done, steps)
+        if self.on_move_done:
+            self.on_move_done(reached)
+
+    def _record_progress(self, state, start, sign, done_event):
+        """journal the position every so often while the stepper runs"""
+        while not done_event.wait(config.DOOR_JOURNAL_INTERVAL):
+            position = start + sign * self.stepper.steps_done
+            # fsync each one: a resume from a stale position would drive
+            # the door past the end of its travel
+            self._store_door_state(state, position)
+
+    def is_moving(self):
+        return self.moving is not None
+
+    def progress(self):
+        """returns (steps done, steps in move) while moving, else None"""
+        if self.moving is None:
+            return None
+        return self.stepper.steps_done, self.move_steps
+
+    def wait(self, timeout=None):
+        """block until the doors stop moving"""
+        return self.actuator.wait(timeout)
+
+    def stop_door(self):
+        logging.info("Doors:Stop request received (MANUAL)")
+        if self.moving is None:
+            return "The doors aren't moving. "
+        # stay where we stop until someone says otherwise
+        self.mode = MANUAL
+        self.actuator.cancel()
+        return "I'm stopping the doors. "
 
     def open_door_auto(self):
         # if we are in auto mode
@@ -117,8 +257,8 @@ class Door(object):
             else:
                 logging.info("Doors:Open request received (AUTO)")
                 self._move_door(OPEN)
-                logging.info("Doors:Opened the doors (AUTO)")
-                return "I just opened the doors. "
+                logging.info("Doors:Opening the doors (AUTO)")
+                return "I'm opening the doors. "
         # if we are in MANUAL mode
         else:
             # if the doors are OPEN
@@ -145,8 +285,8 @@ class Door(object):
             else:
                 logging.info("Doors:Close request received (AUTO)")
                 self._move_door(CLOSED)
-                logging.info("Doors:Opened the doors (AUTO)")
-                return "I just closed the doors. "
+                logging.info("Doors:Closing the doors (AUTO)")
+                return "I'm closing the doors. "
         # if we are in MANUAL mode
         else:
             # if the doors are OPEN
@@ -161,19 +301,25 @@ class Door(object):
                 logging.debug("Doors:Remain in MANUAL mode; stay open")
                 return None
 
+    def will_close_auto(self):
+        """True if close_door_auto() would move the doors now"""
+        return self.mode == AUTO and self.state != CLOSED
+
     def open_door_manual(self):
         logging.info("Doors:Open request received (MANUAL)")
         if self.state == OPEN:
             # switch to auto mode, so door will auto close at sunset
             # self.mode = AUTO
             logging.info("Doors:Already open (MANUAL)")
+            if self.moving == OPEN:
+                return "The doors are already opening. "
             return "The doors are already open. "
         else:
             # switch to manual mode, so auto will not override door
             self.mode = MANUAL
             self._move_door(OPEN)
-            logging.info("Doors:Opened the doors (MANUAL)")
-            return "I just opened the doors. "
+            logging.info("Doors:Opening the doors (MANUAL)")
+            return "I'm opening the doors. "
 
     def close_door_manual(self):
         logging.info("Doors:Close request received (MANUAL)")
@@ -181,13 +327,15 @@ class Door(object):
             # switch to auto mode, so door will auto open at sunrise
             self.mode = AUTO
             logging.info("Doors:Already closed (MANUAL)")
+            if self.moving == CLOSED:
+                return "The doors are already closing. "
             return "The doors are already closed. "
         else:
             # switch to manual mode, so auto will not override door
             self.mode = MANUAL
             self._move_door(CLOSED)
-            logging.info("Doors:Closed the doors (MANUAL)")
-            return "I just closed the doors. "
+            logging.info("Doors:Closing the doors (MANUAL)")
+            return "I'm closing the doors. "
 
     def is_open(self):
         return self.state == OPEN
@@ -202,7 +350,21 @@ class Door(object):
         return self.state == CLOSED
 
     def report(self):
-        if self.state == CLOSED:
+        progress = self.progress()
+        if progress is not None:
+            verb = "opening" if self.moving == OPEN else "closing"
+            text = f"The doors are {verb} ({progress[0]} of {progress[1]} steps) "
+            if (self.mode == AUTO):
+                text += "in AUTOMATIC mode. "
+            else:
+                text += "in MANUAL mode. "
+        elif self.state == PARTIAL:
+            text = "The doors are stopped PART WAY OPEN "
+            if (self.mode == AUTO):
+                text += "in AUTOMATIC mode. "
+            else:
+                text += "in MANUAL mode. "
+        elif self.state == CLOSED:
             # log "Door status: The door is currently CLOSED"
             text = "The doors are currently CLOSED "
             if (self.mode == AUTO):
@@ -222,7 +384,7 @@ class Door(object):
 def main():
     import sys
     logging.basicConfig(
-        filename=sys.stderr,
+        stream=sys.stderr,
         encoding='utf-8',
         format='%(asctime)s %(levelname)s:%(message)s',
         level=logging.DEBUG
@@ -233,10 +395,14 @@ def main():
 
     door = Door(revs)
     door.open_door_manual()
+    sleep(1)
+    logging.info(door.report())
+    door.wait()
     logging.info(door.report())
 
     sleep(1)
     door.close_door_manual()
+    door.wait()
     logging.info(door.report())
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+# grabber.py - background frame grabber for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+#
+# Grown out of experiments/video_capture.py (Luis Mesas' VideoCaptureAsync)
+
+import config
+import threading
+import time
+from lazyimport import lazy_import
+import logging
+
+cv = lazy_import("cv2")
+
+
+class FrameGrabber(object):
+    """holds a usb cam open and keeps only its most recent frame
+
+    A thread reads from the cam continuously, which drains the driver's
+    frame buffer so a snapshot is never stale. If nobody asks for a
+    frame for idle_timeout seconds, the thread releases the cam and
+    exits; the next snapshot() opens it again.
+    """
+
+    def __init__(self, cam_num, max_horz, max_vert, idle_timeout=None):
+        self.cam_num = cam_num
+        self.max_h = max_horz
+        self.max_v = max_vert
+        if idle_timeout is None:
+            idle_timeout = config.CAMERA_IDLE_TIMEOUT
+        self.idle_timeout = idle_timeout
+        self.frame = None
+        self.frame_time = 0
+        self.last_used = time.time()
+        self.started = False
+        self.thread = None
+        self.cond = threading.Condition()
+
+    def _open(self):
+        cam = cv.VideoCapture(self.cam_num)
+        if cam is None or not cam.isOpened():
+            logging.warning("Grabber:Camera %s not found", str(self.cam_num))
+            return None
+        try:
+            cam.set(cv.CAP_PROP_FRAME_WIDTH, self.max_h)
+            cam.set(cv.CAP_PROP_FRAME_HEIGHT, self.max_v)
+        except:
+            logging.warning("Grabber:Failed to setup camera (cv)")
+        return cam
+
+    def start(self):
+        with self.cond:
+            if self.started:
+                return self
+            old_thread = self.thread
+        # let a grabber that is shutting down release the cam first
+        if old_thread is not None and old_thread is not threading.current_thread():
+            old_thread.join()
+        with self.cond:
+            if self.started:
+                return self
+            self.started = True
+            self.last_used = time.time()
+            self.thread = threading.Thread(target=self._run, name=f"grabber-{self.cam_num}", daemon=True)
+            self.thread.start()
+        return self
+
+    def _run(self):
+        # only this thread ever touches the VideoCapture
+        cam = self._open()
+        if cam is None:
+            with self.cond:
+                self.started = False
+                self.cond.notify_all()
+            return
+        logging.info("Grabber:Camera %s open", str(self.cam_num))
+        try:
+            while self.started:
+                if self.idle_timeout and time.time() - self.last_used > self.idle_timeout:
+                    logging.info("Grabber:Camera %s idle, closing", str(self.cam_num))
+                    with self.cond:
+                        self.started = False
+                    break
+                grabbed, frame = cam.read()
+                if not grabbed:
+                    frame = None
+                with self.cond:
+                    self.frame = frame
+                    self.frame_time = time.time()
+                    self.cond.notify_all()
+        except:
+            logging.warning("Grabber:Camera %s failed", str(self.cam_num))
+        finally:
+            cam.release()
+            with self.cond:
+                self.started = False
+                self.frame = None
+                self.cond.notify_all()
+            logging.info("Grabber:Camera %s released", str(self.cam_num))
+
+    def snapshot(self, after=None, timeout=None):
+        """returns a frame read after time after (default now), or None"""
+        if after is None:
+            after = time.time()
+        if timeout is None:
+            timeout = config.CAPTURE_TIMEOUT
+        self.last_used = time.time()
+        self.start()
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.started and self.frame_time <= after:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warning("Grabber:Camera %s timed out", str(self.cam_num))
+                    return None
+                self.cond.wait(remaining)
+            if self.frame is None or self.frame_time <= after:
+                return None
+            return self.frame.copy()
+
+    def is_running(self):
+        return self.started
+
+    def stop(self):
+        with self.cond:
+            self.started = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
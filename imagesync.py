@@ -0,0 +1,142 @@
+# imagesync.py - remote image dir sync for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import io
+import os
+import queue
+import threading
+import sftpsession
+import logging
+
+
+class ImageSync(object):
+    """keeps the remote image dir in step with our latest photos
+
+    We keep a manifest of what is in the remote dir (listed once, then
+    kept up to date as we go), upload only files that aren't there yet,
+    and only then delete the stale ones, in the background. The page is
+    never left without images, and each put is confirmed with a stat
+    rather than by sleeping and hoping.
+    """
+
+    def __init__(self, remote_dir, session=None, workers=None):
+        self.remote_dir = remote_dir
+        self.session = session or sftpsession.get_session()
+        if workers is None:
+            workers = config.SFTP_UPLOAD_WORKERS
+        self.workers = max(1, workers)
+        self.manifest = None
+        self.lock = threading.Lock()
+        self.delete_thread = None
+
+    def _remote_path(self, name):
+        return self.remote_dir + "/" + name
+
+    def _put(self, client, name, data):
+        """put one file from memory (bytes) or from disk (a path)"""
+        if isinstance(data, str):
+            client.put(data, self._remote_path(name))
+        else:
+            client.putfo(io.BytesIO(data), self._remote_path(name), file_size=len(data))
+
+    def _put_all(self, sftp, uploads):
+        """put (name, data) pairs, several sftp channels at once"""
+        if not uploads:
+            return
+        if self.workers == 1 or len(uploads) == 1:
+            for name, data in uploads:
+                self._put(sftp, name, data)
+            return
+        # extra channels ride on the existing ssh transport, so they cost
+        # a round trip each rather than another handshake
+        worker_count = min(self.workers, len(uploads))
+        channels = [self.session.open_channel() for i in range(worker_count - 1)]
+        clients = [sftp.sftp_client] + channels
+        # an sftp client isn't safe to share between threads, so each
+        # thread keeps to its own and takes files from a shared queue
+        todo = queue.SimpleQueue()
+        for upload in uploads:
+            todo.put(upload)
+        errors = []
+
+        def worker(client):
+            while not errors:
+                try:
+                    name, data = todo.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    self._put(client, name, data)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(client,), name="imagesync-put", daemon=True)
+                   for client in clients]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            for channel in channels:
+                channel.close()
+        if errors:
+            raise errors[0]
+
+    def sync(self, images):
+        """make the remote dir hold exactly images; True on success
+
+        images is a list of (filename, data) where data is the encoded
+        bytes, or None to upload filename from disk. Only the basename
+        of filename is used remotely.
+        """
+        # a delete still running from last time would race our manifest
+        if self.delete_thread is not None:
+            self.delete_thread.join()
+        files = [(os.path.basename(filename), filename if data is None else data)
+                 for filename, data in images]
+        names = [name for name, data in files]
+        try:
+            with self.session.connection() as sftp:
+                with self.lock:
+                    if self.manifest is None:
+                        self.manifest = set(sftp.listdir(self.remote_dir))
+                        logging.debug("ImageSync:Remote has %s files", len(self.manifest))
+                    uploads = [(name, data) for name, data in files
+                               if name not in self.manifest]
+                logging.debug("ImageSync:Uploading %s files via sftp", len(uploads))
+                self._put_all(sftp, uploads)
+                with self.lock:
+                    self.manifest.update(name for name, data in uploads)
+        except:
+            # we don't know what made it, so list the dir again next time
+            with self.lock:
+                self.manifest = None
+            logging.warning("ImageSync:Failed to upload photos")
+            return False
+        with self.lock:
+            stale = self.manifest - set(names)
+        if stale:
+            self.delete_thread = threading.Thread(target=self._delete, args=(stale,),
+                                                  name="imagesync-delete", daemon=True)
+            self.delete_thread.start()
+        return True
+
+    def _delete(self, stale):
+        logging.debug("ImageSync:Deleting %s old files via sftp", len(stale))
+        try:
+            with self.session.connection() as sftp:
+                for name in stale:
+                    try:
+                        sftp.remove(self._remote_path(name))
+                    except IOError:
+                        # already gone
+                        pass
+                    with self.lock:
+                        if self.manifest is not None:
+                            self.manifest.discard(name)
+        except:
+            logging.warning("ImageSync:Failed to delete old photos")
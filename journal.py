@@ -0,0 +1,156 @@
+# journal.py - crash-safe state journal for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import os
+import threading
+import zlib
+import logging
+
+# the most a record line can take up; recovery reads this many records
+# back from the end of the journal, never the whole file
+MAX_RECORD_BYTES = 128
+TAIL_RECORDS = 8
+
+
+def _encode(seq, fields):
+    body = " ".join(str(v) for v in [seq] + list(fields))
+    return f"{body} {zlib.crc32(body.encode()):08x}\n"
+
+def _decode(line):
+    """returns (seq, [int fields]) or None if the line is torn or corrupt"""
+    body, sep, crc = line.strip().rpartition(" ")
+    if not sep:
+        return None
+    try:
+        if int(crc, 16) != zlib.crc32(body.encode()):
+            return None
+        values = [int(v) for v in body.split()]
+    except ValueError:
+        return None
+    return values[0], values[1:]
+
+
+class Journal(object):
+    """an append-only log of small integer records, with a snapshot
+
+    Each append is a checksummed line, so a write torn by a power cut is
+    recognised and skipped. Appends are fsynced in batches of fsync_batch
+    (or at once when asked to). Every compact_every records, the latest
+    record is written atomically to the snapshot file and the journal is
+    emptied, so it stays small and recovery only ever has to read the
+    snapshot and the last few lines of the journal.
+    """
+
+    def __init__(self, path, snapshot_path, fsync_batch=None, compact_every=None):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.fsync_batch = config.JOURNAL_FSYNC_BATCH if fsync_batch is None else fsync_batch
+        self.compact_every = config.JOURNAL_COMPACT_RECORDS if compact_every is None else compact_every
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.unsynced = 0
+        self.since_compact = 0
+        self.file = None
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_path, 'r') as file:
+                return _decode(file.read())
+        except (IOError, OSError):
+            return None
+
+    def _read_tail(self):
+        """returns the newest valid record in the journal, or None"""
+        try:
+            with open(self.path, 'rb') as file:
+                file.seek(0, os.SEEK_END)
+                size = file.tell()
+                file.seek(max(0, size - MAX_RECORD_BYTES * TAIL_RECORDS))
+                tail = file.read().decode('utf-8', 'replace')
+        except (IOError, OSError):
+            return None
+        for line in reversed(tail.splitlines()):
+            record = _decode(line)
+            if record is not None:
+                return record
+        return None
+
+    def recover(self):
+        """returns the fields of the newest intact record, or None"""
+        with self.lock:
+            newest = None
+            for record in (self._read_snapshot(), self._read_tail()):
+                if record is not None and (newest is None or record[0] > newest[0]):
+                    newest = record
+            if newest is None:
+                return None
+            self.seq = newest[0]
+            return newest[1]
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self.path, 'a')
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def append(self, fields, sync=False):
+        """record fields (a list of ints); sync forces them to disk now"""
+        with self.lock:
+            self._open()
+            self.seq += 1
+            self.file.write(_encode(self.seq, fields))
+            self.file.flush()
+            self.unsynced += 1
+            self.since_compact += 1
+            if sync or self.unsynced >= self.fsync_batch:
+                self._sync()
+            if self.since_compact >= self.compact_every:
+                self._compact(fields)
+
+    def _compact(self, fields):
+        # the snapshot goes down first, atomically; only then is it safe
+        # to throw the journal away
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'w') as file:
+            file.write(_encode(self.seq, fields))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        _fsync_dir(self.snapshot_path)
+        self.file.close()
+        self.file = open(self.path, 'w')
+        self._sync()
+        self.since_compact = 0
+        logging.debug("Journal:Compacted %s at seq %s", self.path, self.seq)
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None and self.unsynced:
+                self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                if self.unsynced:
+                    self._sync()
+                self.file.close()
+                self.file = None
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
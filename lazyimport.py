@@ -0,0 +1,47 @@
+# lazyimport.py - deferred module imports for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import importlib
+import threading
+import logging
+
+# cv2, numpy, twilio and pysftp/paramiko take seconds to import on a Pi,
+# and the door and light don't need any of them. Modules that use them
+# hold a LazyModule instead, so the import happens on first use:
+#
+#   cv = lazy_import("cv2")
+#   ...
+#   cv.imencode(...)    # cv2 is imported here
+
+
+class LazyModule(object):
+    """stands in for a module until an attribute is first asked for"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    logging.debug("Lazyimport:Importing %s", self._name)
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def is_loaded(self):
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -5,72 +5,118 @@
 
 import config
 import datetime
+import threading
 from suntime import Sun, SunTimeException
 from datetime import datetime, timedelta
+from collections import OrderedDict, namedtuple
 from dateutil import tz
+import clock
 import logging
 
 # Auto-detect timezones
 from_zone = tz.tzutc()
 to_zone = tz.tzlocal()
 
+# Transition states
+OPEN = "open"
+CLOSE = "close"
+
+SunTimes = namedtuple("SunTimes", ["sunrise", "open_door", "sunset", "close_door"])
+Transition = namedtuple("Transition", ["when", "state"])
+
 class Light(object):
     """reports sunrise and sunset times"""
-    def __init__(self, location, lat, long, sunrise_delay, sunset_delay):
+    def __init__(self, location, lat, long, sunrise_delay, sunset_delay, cache_days=None):
         self.location = location
         self.lat = lat
         self.long = long
         self.sunrise_delay = sunrise_delay
         self.sunset_delay = sunset_delay
         self.sun = Sun(lat, long)
+        if cache_days is None:
+            cache_days = config.LIGHT_CACHE_DAYS
+        self.cache_days = max(1, cache_days)
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def _now(self, dt=None):
+        if dt: return dt
+        return clock.now()
+
+    def times(self, dt=None):
+        """returns the day's sun and door times, computed once per local day"""
+        day = self._now(dt)
+        if isinstance(day, datetime):
+            day = day.date()
+        with self.cache_lock:
+            times = self.cache.get(day)
+            if times is not None:
+                self.cache.move_to_end(day)
+                return times
+        sr = self.sun.get_local_sunrise_time(day)
+        ss = self.sun.get_local_sunset_time(day)
+        if ss < sr:
+            ss = self.sun.get_local_sunset_time(day + timedelta(1))
+        times = SunTimes(
+            sunrise=sr,
+            open_door=sr + timedelta(minutes=self.sunrise_delay),
+            sunset=ss,
+            close_door=ss + timedelta(minutes=self.sunset_delay))
+        logging.debug("Light:Computed sun times for %s", day)
+        with self.cache_lock:
+            self.cache[day] = times
+            while len(self.cache) > self.cache_days:
+                self.cache.popitem(last=False)
+        return times
 
     def sunrise(self, dt=None):
         """returns today's sunrise in local time"""
-        return self.sun.get_local_sunrise_time(dt)
+        return self.times(dt).sunrise
 
     def open_door(self, dt=None):
         """returns today's sunrise in local time + sunrise_delay """
-        return self.sunrise(dt) + timedelta(minutes=self.sunrise_delay)
+        return self.times(dt).open_door
 
     def sunset(self, dt=None):
         """returns today's sunset in local time"""
-        ss = self.sun.get_local_sunset_time(dt)
-        sr = self.sun.get_local_sunrise_time(dt)
-        if ss < sr:
-            tomorrow = datetime.now().astimezone(to_zone) +             timedelta(1)
-            ss = self.sun.get_local_sunset_time(tomorrow)
-        return ss
+        return self.times(dt).sunset
 
     def close_door(self, dt=None):
         """returns today's sunset in local time + sunset_delay"""
-        return self.sunset(dt) + timedelta(minutes=self.sunset_delay)
+        return self.times(dt).close_door
 
     def is_dark(self, dt=None):
-        now = datetime.now().astimezone(to_zone)
-        if dt: now = dt
-        od = self.open_door(dt)
-        cd = self.close_door(dt)
-        if od < now < cd:
+        now = self._now(dt)
+        times = self.times(now)
+        # the same half-open day as next_transition(), so a check woken
+        # at the open instant sees light and opens
+        if times.open_door <= now < times.close_door:
             return False
         return True
 
     def is_light(self, dt=None):
         return not self.is_dark(dt)
 
+    def next_transition(self, dt=None):
+        """returns the next door Transition (when, OPEN or CLOSE) after now"""
+        now = self._now(dt)
+        times = self.times(now)
+        if now < times.open_door:
+            return Transition(times.open_door, OPEN)
+        if now < times.close_door:
+            return Transition(times.close_door, CLOSE)
+        return Transition(self.open_door(now + timedelta(1)), OPEN)
+
     def report(self, dt=None):
         """returns a report string"""
-        sr = self.sunrise(dt)
-        od = self.open_door(dt)
-        ss = self.sunset(dt)
-        cd = self.close_door(dt)
-        now = datetime.now().astimezone(to_zone)
-        if dt: now = dt
+        now = self._now(dt)
+        sr, od, ss, cd = self.times(now)
         logging.debug("Light:Now:%s", now.strftime(config.TIME_FORMAT))
         logging.debug("Light:Sunrise:%s", sr.strftime(config.TIME_FORMAT))
         logging.debug("Light:Open door:%s", od.strftime(config.TIME_FORMAT))
         logging.debug("Light:Sunset:%s", ss.strftime(config.TIME_FORMAT))
         logging.debug("Light:Close door:%s", cd.strftime(config.TIME_FORMAT))
-        if self.is_dark(dt):
+        if not od <= now < cd:
             text = f"It is dark now in {self.location}. "
         else:
             text = f"It is daylight now in {self.location}. "
@@ -97,8 +143,7 @@ class Light(object):
                 text += f" and it will be dark enough to close the doors at {cd.strftime(config.TIME_FORMAT)}. "
             else:
                 text += f" and it was dark enough to close the doors at {cd.strftime(config.TIME_FORMAT)}. "
-            tomorrow = datetime.now().astimezone(to_zone) +             timedelta(1)
-            srt = self.sunrise(tomorrow)
+            srt = self.sunrise(now + timedelta(1))
             text += f"Tomorrow's sunrise is at {srt.strftime(config.TIME_FORMAT)}. "
         logging.info("Report:%s", text)
         return text
@@ -107,7 +152,7 @@ class Light(object):
 def main():
     import sys
     logging.basicConfig(
-        filename=sys.stderr,
+        stream=sys.stderr,
         encoding='utf-8',
         format='%(asctime)s %(levelname)s:%(message)s',
         level=logging.DEBUG
@@ -124,6 +169,7 @@ def main():
     light = Light(city_name, latitude, longitude, sunrise_delay, sunset_delay)
     # now = datetime.now().astimezone(to_zone) + timedelta(hours=10)
     logging.info("Door:Report:%s", light.report())
+    logging.info("Light:Next transition:%s", light.next_transition())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,198 @@
+# localserver.py - local web server for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import re
+import threading
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import metrics
+import logging
+
+# Everything here comes straight from memory: the status page as last
+# rendered, and the photos as last encoded. Nothing touches the disk or
+# the remote server, so it's quick on the LAN even with uploads off.
+#
+#   /  or /status.html      the status page
+#   /status.json            the same, for machines
+#   /cam/<n>.jpg            newest photo from cam n (also .thumb.jpg, .mms.jpg)
+#   /cam/<n>.mjpg           live view from cam n
+#   /images/<filename>      a photo the status page links to
+
+CAM_PATH = re.compile(r"^/cam/(\d+)(?:\.(thumb|mms))?\.(jpg|mjpg)$")
+BOUNDARY = "frame"
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header covers etag"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    # a weak validator is good enough for a GET
+    return "*" in tags or etag in tags or "W/" + etag in tags
+
+
+class LocalServer(object):
+    """serves the status page, the latest photos and a live view on the LAN"""
+
+    def __init__(self, camera, status_page, port=None, host=None, max_streams=None):
+        self.camera = camera
+        self.status_page = status_page
+        self.port = config.LOCAL_SERVER_PORT if port is None else port
+        self.host = config.LOCAL_SERVER_HOST if host is None else host
+        if max_streams is None:
+            max_streams = config.MJPEG_MAX_STREAMS
+        self.streams = threading.BoundedSemaphore(max_streams)
+        self.server = None
+        self.thread = None
+
+    def _make_handler(self):
+        local = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                local.handle(self, urlsplit(self.path).path)
+
+            def log_message(self, format, *args):
+                logging.debug("Local:" + format, *args)
+
+        return Handler
+
+    def handle(self, request, path):
+        if path in ("/", "/status.html", "/status.json"):
+            rendered = self.status_page.local
+            if rendered is None:
+                self._send_error(request, 503, "No status yet")
+                return
+            digest, html_body, json_body = rendered
+            if path == "/status.json":
+                self._send_cached(request, json_body, '"j-%s"' % digest[:16], "application/json")
+            else:
+                self._send_cached(request, html_body, '"h-%s"' % digest[:16], "text/html; charset=utf-8")
+            return
+        match = CAM_PATH.match(path)
+        if match:
+            image_num = int(match.group(1))
+            if match.group(3) == "mjpg":
+                self._stream(request, image_num)
+                return
+            latest = self.camera.latest_image(image_num, match.group(2) or "full")
+            if latest is None:
+                self._send_error(request, 404, "No such camera")
+                return
+            filename, data = latest
+            # filenames are new for every photo, so they make good etags
+            self._send_cached(request, data, '"%s"' % filename.rsplit("/", 1)[-1], "image/jpeg")
+            return
+        if path.startswith("/images/"):
+            data = self.camera.image_by_name(path[1:])
+            if data is None:
+                self._send_error(request, 404, "Not found")
+                return
+            self._send_cached(request, data, '"%s"' % path.rsplit("/", 1)[-1], "image/jpeg",
+                              "max-age=86400, immutable")
+            return
+        self._send_error(request, 404, "Not found")
+
+    def _send_cached(self, request, body, etag, content_type, cache_control="no-cache"):
+        """send body, or 304 if the client already has this version"""
+        if etag_matches(request.headers.get("If-None-Match"), etag):
+            metrics.inc("local_requests_total", result="not_modified")
+            request.send_response(304)
+            request.send_header("ETag", etag)
+            request.send_header("Cache-Control", cache_control)
+            request.end_headers()
+            return
+        metrics.inc("local_requests_total", result="ok")
+        request.send_response(200)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.send_header("ETag", etag)
+        request.send_header("Cache-Control", cache_control)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _send_error(self, request, code, text):
+        metrics.inc("local_requests_total", result=str(code))
+        body = text.encode("utf-8")
+        request.send_response(code)
+        request.send_header("Content-Type", "text/plain; charset=utf-8")
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _stream(self, request, image_num):
+        """send frames as multipart/x-mixed-replace until the viewer leaves"""
+        if not self.streams.acquire(blocking=False):
+            self._send_error(request, 503, "Too many viewers")
+            return
+        frames = self.camera.live_frames(image_num)
+        try:
+            first = next(frames, None)
+            if first is None:
+                self._send_error(request, 404, "No such camera")
+                return
+            logging.info("Local:Live view of camera %s started", image_num)
+            metrics.inc("local_requests_total", result="stream")
+            request.send_response(200)
+            request.send_header("Content-Type", "multipart/x-mixed-replace; boundary=" + BOUNDARY)
+            request.send_header("Cache-Control", "no-cache, no-store")
+            request.send_header("Connection", "close")
+            request.end_headers()
+            data = first
+            while data is not None:
+                request.wfile.write(b"--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+                                    % (BOUNDARY.encode("ascii"), len(data)))
+                request.wfile.write(data)
+                request.wfile.write(b"\r\n")
+                request.wfile.flush()
+                data = next(frames, None)
+            logging.info("Local:Live view of camera %s ended", image_num)
+        except (BrokenPipeError, ConnectionResetError):
+            logging.info("Local:Live view of camera %s closed by viewer", image_num)
+        finally:
+            frames.close()
+            self.streams.release()
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="localserver", daemon=True)
+        self.thread.start()
+        logging.info("Local:Serving on %s:%s", *self.server.server_address[:2])
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main():
+    import sys
+    from camera import Camera
+    from status import StatusPage
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.DEBUG
+    )
+    # take a set of photos and serve them, without uploading anything
+    config.REMOTE_UPLOAD = False
+    camera = Camera(config.MAX_HORZ, config.MAX_VERT)
+    status_page = StatusPage(upload=False)
+    renditions = camera.take_and_upload_images()
+    status_page.publish(camera.report(), "Here's photos of the coop. ",
+                        renditions["full"], renditions["thumb"], renditions["mms"])
+    server = LocalServer(camera, status_page).start()
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
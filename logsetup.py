@@ -0,0 +1,155 @@
+# logsetup.py - background logging for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import os
+import sys
+import queue
+import logging
+import logging.handlers
+from streamtologger import StreamToLogger
+
+# Log calls on the control threads only put the record on a queue; a
+# listener thread does the writing to disk, so a slow SD card can
+# never hold up the door or the cams.
+
+LOG_FORMAT = '%(asctime)s %(levelname)s:%(message)s'
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """a QueueHandler that drops records rather than block on a full queue"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # counted and reported by the listener once it catches up
+            self.dropped += 1
+
+
+class _BatchedFlush(object):
+    """holds back flushes until flush_batch records have been written
+
+    StreamHandler flushes after every record; on an SD card that's a
+    write per line. The listener calls flush_now() whenever its queue
+    runs dry, so nothing sits unwritten once a burst is over.
+    """
+
+    def _init_batch(self, flush_batch):
+        self.flush_batch = max(1, flush_batch)
+        self.pending = 0
+
+    def flush(self):
+        self.pending += 1
+        if self.pending >= self.flush_batch:
+            self.flush_now()
+
+    def flush_now(self):
+        self.pending = 0
+        super().flush()
+
+    def close(self):
+        self.flush_now()
+        super().close()
+
+
+class BatchedRotatingFileHandler(_BatchedFlush, logging.handlers.RotatingFileHandler):
+    """rotates when the file passes max_bytes"""
+
+    def __init__(self, filename, max_bytes, backups, flush_batch):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+        self._init_batch(flush_batch)
+
+
+class BatchedTimedRotatingFileHandler(_BatchedFlush, logging.handlers.TimedRotatingFileHandler):
+    """rotates on a schedule (e.g. at midnight)"""
+
+    def __init__(self, filename, when, backups, flush_batch):
+        super().__init__(filename, when=when, backupCount=backups, encoding='utf-8')
+        self._init_batch(flush_batch)
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """a QueueListener that flushes its handlers when the queue runs dry"""
+
+    def __init__(self, log_queue, queue_handler, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self.reported_drops = 0
+
+    def dequeue(self, block):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            pass
+        self._report_drops()
+        for handler in self.handlers:
+            if hasattr(handler, "flush_now"):
+                handler.flush_now()
+            else:
+                handler.flush()
+        return self.queue.get(block)
+
+    def _report_drops(self):
+        dropped = self.queue_handler.dropped
+        if dropped != self.reported_drops:
+            record = logging.makeLogRecord({
+                "name": "logsetup",
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": "Log:Queue full, dropped %s records",
+                "args": (dropped - self.reported_drops,),
+            })
+            self.reported_drops = dropped
+            self.handle(record)
+
+
+def _file_handler(filename):
+    if config.LOG_ROTATE == "time":
+        return BatchedTimedRotatingFileHandler(filename, config.LOG_ROTATE_WHEN,
+                                               config.LOG_BACKUPS, config.LOG_FLUSH_BATCH)
+    return BatchedRotatingFileHandler(filename, config.LOG_MAX_BYTES,
+                                      config.LOG_BACKUPS, config.LOG_FLUSH_BATCH)
+
+def start_logging(filename=None, level=None, redirect=True):
+    """log to a rotating file from a background thread; returns the listener
+
+    With redirect, stdout and stderr go to the log too. Call
+    stop_logging() with the listener on the way out to flush the rest.
+    """
+    filename = config.LOG_FILENAME if filename is None else filename
+    level = config.LOG_LEVEL if level is None else level
+    log_dir = os.path.dirname(filename)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    file_handler = _file_handler(filename)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.Queue(config.LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = BatchingQueueListener(log_queue, queue_handler, file_handler)
+    listener.start()
+    if redirect:
+        logger = logging.getLogger("chickenrobot")
+        sys.stdout = StreamToLogger(logger, logging.INFO)
+        sys.stderr = StreamToLogger(logger, logging.ERROR)
+    return listener
+
+def stop_logging(listener):
+    """write out everything still queued and close the log"""
+    for stream in (sys.stdout, sys.stderr):
+        if isinstance(stream, StreamToLogger):
+            stream.flush()
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,267 @@
+# metrics.py - counters and latency histograms for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import os
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+
+# Every metric name gets this prefix on export
+PREFIX = "chickenrobot_"
+# Latency buckets (secs), from a quick GPIO write up to a slow sftp upload
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    "stage_seconds": "Time spent in each stage of the controller",
+    "stage_errors_total": "Stages that failed",
+    "scheduler_events_total": "Scheduler events run",
+    "scheduler_lateness_seconds": "How long after its due time a scheduler event ran",
+    "event_seconds": "Time spent running each scheduler event",
+    "command_seconds": "Time spent handling each SMS command",
+    "commands_total": "SMS commands handled",
+    "messages_sent_total": "Messages sent, by result",
+    "status_uploads_total": "Status page publishes, by result",
+    "photo_cache_total": "Photo requests served from a new capture or the cache",
+    "camera_changes_total": "Photos compared with their cam's background, by result",
+    "door_moves_total": "Door moves finished",
+    "door_steps_total": "Stepper steps made",
+    "local_requests_total": "Local server responses, by result",
+    "mjpeg_frames_total": "Live view frames sent",
+    "vision_checks_total": "Doorway checks before an automatic close, by result",
+    "vision_seconds": "Time from asking for a doorway check to its answer",
+}
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}      # (name, labels) -> value
+_histograms = {}    # (name, labels) -> [bucket counts, sum, count]
+
+
+class _NullTimer(object):
+    """what timed() hands out while metrics are off"""
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+def enabled():
+    return _enabled
+
+def enable(on=True):
+    global _enabled
+    _enabled = on
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """add value to a counter"""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, value, **labels):
+    """record one value (usually secs) in a histogram"""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+        index = bisect.bisect_left(BUCKETS, value)
+        if index < len(BUCKETS):
+            hist[0][index] += 1
+        hist[1] += value
+        hist[2] += 1
+
+@contextmanager
+def _timer(name, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    except:
+        inc("stage_errors_total", **labels)
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+def timed(name="stage_seconds", **labels):
+    """a context manager that records how long its block takes
+
+    With metrics off this is a shared do-nothing object, so leaving
+    the instrumentation in costs next to nothing.
+    """
+    if not _enabled:
+        return _NULL_TIMER
+    return _timer(name, labels)
+
+def stage(stage_name):
+    """time a block as one stage: with metrics.stage("capture"): ..."""
+    if not _enabled:
+        return _NULL_TIMER
+    return _timer("stage_seconds", {"stage": stage_name})
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def render():
+    """returns every metric in the prometheus text exposition format"""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, [list(hist[0]), hist[1], hist[2]])
+                            for key, hist in _histograms.items())
+    lines = []
+    seen = set()
+    def header(name, kind):
+        if name not in seen:
+            seen.add(name)
+            if name in HELP:
+                lines.append(f"# HELP {PREFIX}{name} {HELP[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+    for (name, labels), value in counters:
+        header(name, "counter")
+        lines.append(f"{PREFIX}{name}{_format_labels(labels)} {_format_value(value)}")
+    for (name, labels), (buckets, total, count) in histograms:
+        header(name, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, ('le', bound))} {cumulative}")
+        lines.append(f"{PREFIX}{name}_bucket{_format_labels(labels, ('le', '+Inf'))} {count}")
+        lines.append(f"{PREFIX}{name}_sum{_format_labels(labels)} {_format_value(total)}")
+        lines.append(f"{PREFIX}{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def dump(path):
+    """write render() to path atomically"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as file:
+        file.write(render())
+    os.replace(tmp_path, path)
+
+
+class MetricsExporter(object):
+    """serves /metrics over http and/or dumps it to a file periodically"""
+
+    def __init__(self, port=None, path=None, interval=None, host=""):
+        self.port = config.METRICS_PORT if port is None else port
+        self.path = config.METRICS_FILE if path is None else path
+        self.interval = config.METRICS_DUMP_INTERVAL if interval is None else interval
+        self.host = host
+        self.server = None
+        self.stopped = threading.Event()
+        self.threads = []
+
+    def _make_handler(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug("Metrics:" + format, *args)
+
+        return Handler
+
+    def _dump_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                dump(self.path)
+            except (IOError, OSError):
+                logging.warning("Metrics:Failed to write %s", self.path)
+
+    def start(self):
+        if self.port:
+            self.server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+            thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+            logging.info("Metrics:Serving on port %s", self.server.server_address[1])
+        if self.path:
+            thread = threading.Thread(target=self._dump_loop, name="metrics-dump", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+            logging.info("Metrics:Dumping to %s every %ss", self.path, self.interval)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.path:
+            try:
+                dump(self.path)
+            except (IOError, OSError):
+                pass
+
+
+def start():
+    """turn metrics on and start exporting, if config asks for it"""
+    if not config.METRICS_ENABLED:
+        return None
+    enable()
+    return MetricsExporter().start()
+
+
+def main():
+    import sys
+    import urllib.request
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.DEBUG
+    )
+    # record a few things and read them back over http
+    enable()
+    for i in range(5):
+        with stage("demo"):
+            time.sleep(0.01 * i)
+    inc("commands_total", command="status")
+    exporter = MetricsExporter(path="").start()
+    url = f"http://127.0.0.1:{exporter.server.server_address[1]}/metrics"
+    with urllib.request.urlopen(url) as response:
+        print(response.read().decode("utf-8"))
+    exporter.stop()
+
+if __name__ == '__main__':
+    main()
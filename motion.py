@@ -0,0 +1,288 @@
+# motion.py - stepper pulse trains for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import sys
+if sys.platform == "darwin":
+    # OS X
+    import fake_rpi
+    sys.modules['RPi'] = fake_rpi.RPi     # Fake RPi
+    sys.modules['RPi.GPIO'] = fake_rpi.RPi.GPIO # Fake GPIO
+from lazyimport import lazy_import
+from collections import namedtuple
+import bisect
+import itertools
+import time
+import logging
+
+# imported when a backend first touches the pins, so importing us (or
+# the controller) works off the Pi
+GPIO = lazy_import("RPi.GPIO")
+
+
+def pin_numbering():
+    """returns the RPi.GPIO mode named by config.PINOUT_SCHEME"""
+    return getattr(GPIO, config.PINOUT_SCHEME)
+
+
+# A whole door move, worked out before the first step: the direction pin
+# level, and for each step how long (secs) STEP_PIN stays high and then
+# low. Backends only have to play it back.
+#
+# Every backend's run(move, cancel=None) returns the number of steps it
+# made, stopping early if the cancel Event is set, and keeps steps_done
+# up to date while it runs so other threads can watch progress.
+Move = namedtuple("Move", ["direction", "half_periods"])
+
+
+def compile_move(direction, steps, step_delay):
+    """returns a constant-speed Move of steps steps"""
+    return Move(direction, [step_delay] * steps)
+
+def move_duration(move):
+    return 2 * sum(move.half_periods)
+
+
+class RPiGPIOBackend(object):
+    """plays a Move from a python loop with RPi.GPIO (the original way)
+
+    Timing is only as good as the OS scheduler, but it needs nothing
+    beyond RPi.GPIO. We sleep to absolute deadlines, so a late edge
+    doesn't push every later edge back too.
+    """
+    name = "rpigpio"
+
+    def __init__(self, dir_pin, step_pin):
+        self.dir_pin = dir_pin
+        self.step_pin = step_pin
+        self.steps_done = 0
+
+    def setup(self):
+        GPIO.setwarnings(False)
+        GPIO.setmode(pin_numbering())
+        GPIO.setup(self.dir_pin, GPIO.OUT)
+        GPIO.setup(self.step_pin, GPIO.OUT)
+
+    def run(self, move, cancel=None):
+        self.steps_done = 0
+        # looked up once, not through the lazy module on every edge
+        output, high, low = GPIO.output, GPIO.HIGH, GPIO.LOW
+        output(self.dir_pin, move.direction)
+        deadline = time.perf_counter()
+        for half_period in move.half_periods:
+            if cancel is not None and cancel.is_set():
+                break
+            output(self.step_pin, high)
+            deadline += half_period
+            _sleep_until(deadline)
+            output(self.step_pin, low)
+            deadline += half_period
+            _sleep_until(deadline)
+            self.steps_done += 1
+        return self.steps_done
+
+    def close(self):
+        pass
+
+
+class PigpioBackend(object):
+    """hands a Move to the pigpio daemon as DMA-timed waveforms
+
+    Edges are placed by the daemon's DMA engine to the microsecond, so
+    python never sits in the timing loop. Needs pigpiod running.
+    """
+    name = "pigpio"
+    # pulses per waveform; pigpio's default wave buffers hold ~12000
+    CHUNK_STEPS = 1000
+
+    def __init__(self, dir_pin, step_pin):
+        import pigpio
+        self.pigpio = pigpio
+        self.pi = pigpio.pi()
+        if not self.pi.connected:
+            raise RuntimeError("pigpiod not running")
+        self.dir_pin = dir_pin
+        self.step_pin = step_pin
+        self.steps_done = 0
+
+    def setup(self):
+        self.pi.set_mode(self.dir_pin, self.pigpio.OUTPUT)
+        self.pi.set_mode(self.step_pin, self.pigpio.OUTPUT)
+
+    def _create_wave(self, half_periods):
+        pulse = self.pigpio.pulse
+        step_mask = 1 << self.step_pin
+        pulses = []
+        for half_period in half_periods:
+            us = max(1, int(round(half_period * 1000000)))
+            pulses.append(pulse(step_mask, 0, us))
+            pulses.append(pulse(0, step_mask, us))
+        self.pi.wave_add_generic(pulses)
+        return self.pi.wave_create()
+
+    def run(self, move, cancel=None):
+        self.steps_done = 0
+        self.pi.write(self.dir_pin, move.direction)
+        self.pi.wave_clear()
+        waves = []
+        # when each step ends, relative to the start of the chain, so we
+        # can tell how far the DMA engine has got from the clock alone
+        step_ends = list(itertools.accumulate(2 * half_period for half_period in move.half_periods))
+        try:
+            for start in range(0, len(move.half_periods), self.CHUNK_STEPS):
+                waves.append(self._create_wave(move.half_periods[start:start + self.CHUNK_STEPS]))
+            if waves:
+                started = time.perf_counter()
+                self.pi.wave_chain(waves)
+                while self.pi.wave_tx_busy():
+                    elapsed = time.perf_counter() - started
+                    if cancel is not None and cancel.is_set():
+                        self.pi.wave_tx_stop()
+                        self.steps_done = bisect.bisect_right(step_ends, elapsed)
+                        return self.steps_done
+                    self.steps_done = bisect.bisect_right(step_ends, elapsed)
+                    time.sleep(0.01)
+            self.steps_done = len(move.half_periods)
+        finally:
+            for wave in waves:
+                self.pi.wave_delete(wave)
+        return self.steps_done
+
+    def close(self):
+        self.pi.stop()
+
+
+class GpiodBackend(object):
+    """plays a Move through the libgpiod character device
+
+    Still timed from python, but a line write is one ioctl, much cheaper
+    than RPi.GPIO's sysfs path, so edges land closer to their deadlines.
+    """
+    name = "gpiod"
+
+    def __init__(self, dir_pin, step_pin):
+        import gpiod
+        self.gpiod = gpiod
+        self.chip = gpiod.Chip(config.GPIOD_CHIP)
+        self.dir_pin = dir_pin
+        self.step_pin = step_pin
+        self.lines = None
+        self.steps_done = 0
+
+    def setup(self):
+        self.lines = self.chip.get_lines([self.dir_pin, self.step_pin])
+        self.lines.request(consumer="chickenrobot", type=self.gpiod.LINE_REQ_DIR_OUT)
+
+    def run(self, move, cancel=None):
+        self.steps_done = 0
+        lines = self.lines
+        d = move.direction
+        lines.set_values([d, 0])
+        deadline = time.perf_counter()
+        for half_period in move.half_periods:
+            if cancel is not None and cancel.is_set():
+                break
+            lines.set_values([d, 1])
+            deadline += half_period
+            _sleep_until(deadline)
+            lines.set_values([d, 0])
+            deadline += half_period
+            _sleep_until(deadline)
+            self.steps_done += 1
+        return self.steps_done
+
+    def close(self):
+        if self.lines is not None:
+            self.lines.release()
+        self.chip.close()
+
+
+class SimulatedBackend(object):
+    """records the edges a Move would produce, for tests and benchmarks
+
+    By default no time passes and edges are stamped with their ideal
+    times. With realtime, we sleep like the python backends and stamp
+    edges with when they actually happened, to measure jitter.
+    """
+    name = "sim"
+
+    def __init__(self, dir_pin, step_pin, realtime=False):
+        self.dir_pin = dir_pin
+        self.step_pin = step_pin
+        self.realtime = realtime
+        self.edges = []
+        self.steps_done = 0
+
+    def setup(self):
+        pass
+
+    def run(self, move, cancel=None):
+        self.steps_done = 0
+        edges = self.edges = [(0.0, self.dir_pin, move.direction)]
+        start = time.perf_counter()
+        t = 0.0
+        for half_period in move.half_periods:
+            if cancel is not None and cancel.is_set():
+                break
+            for level in (1, 0):
+                if self.realtime:
+                    edges.append((time.perf_counter() - start, self.step_pin, level))
+                    t += half_period
+                    _sleep_until(start + t)
+                else:
+                    edges.append((t, self.step_pin, level))
+                    t += half_period
+            self.steps_done += 1
+        return self.steps_done
+
+    def close(self):
+        pass
+
+
+BACKENDS = {
+    RPiGPIOBackend.name: RPiGPIOBackend,
+    PigpioBackend.name: PigpioBackend,
+    GpiodBackend.name: GpiodBackend,
+    SimulatedBackend.name: SimulatedBackend,
+}
+
+def get_backend(name, dir_pin=None, step_pin=None):
+    """returns the named stepper backend, falling back to RPi.GPIO"""
+    if dir_pin is None:
+        dir_pin = config.DIR_PIN
+    if step_pin is None:
+        step_pin = config.STEP_PIN
+    try:
+        return BACKENDS[name](dir_pin, step_pin)
+    except:
+        logging.warning("Motion:Stepper backend %s unavailable, using %s", name, RPiGPIOBackend.name)
+        return RPiGPIOBackend(dir_pin, step_pin)
+
+def _sleep_until(deadline):
+    remaining = deadline - time.perf_counter()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def main():
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.DEBUG
+    )
+    # play one door move into the simulator and see how late the edges were
+    step_delay = 1 / config.SPR
+    move = compile_move(1, config.REVS * config.SPR, step_delay)
+    sim = SimulatedBackend(config.DIR_PIN, config.STEP_PIN, realtime=True)
+    sim.run(move)
+    ideal = [i * step_delay for i in range(len(sim.edges) - 1)]
+    lateness = [edge[0] - t for edge, t in zip(sim.edges[1:], ideal)]
+    logging.info("Motion:%s edges over %.2fs", len(sim.edges), move_duration(move))
+    logging.info("Motion:Edge lateness max %.2fms, mean %.3fms",
+                 max(lateness) * 1000, sum(lateness) / len(lateness) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+# planner.py - stepper motion profiles for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import sys
+import math
+from functools import lru_cache
+from motion import Move, compile_move
+from lazyimport import lazy_import
+import logging
+
+# numpy is only needed once the door first moves
+np = lazy_import("numpy")
+
+# Profiles
+CONSTANT = "constant"       # one speed throughout (the original behaviour)
+TRAPEZOID = "trapezoid"     # constant acceleration up to max speed and back
+SCURVE = "scurve"           # jerk-limited: acceleration itself ramps in and out
+
+# points per ramp when inverting the s-curve position curve
+RAMP_SAMPLES = 4096
+
+
+def _trapezoid_ramp(v0, vmax, accel):
+    """returns (ramp time, ramp distance, time-at-distance function)"""
+    t_ramp = (vmax - v0) / accel
+    d_ramp = (v0 + vmax) / 2 * t_ramp
+    def time_at(s):
+        return (np.sqrt(v0 * v0 + 2 * accel * s) - v0) / accel
+    return t_ramp, d_ramp, time_at
+
+def _scurve_ramp(v0, vmax, accel, jerk):
+    """a raised-cosine velocity ramp, long enough to respect accel and jerk
+
+    v(t) = v0 + (vmax - v0) * (1 - cos(pi t / T)) / 2 peaks at an accel
+    of (vmax - v0) pi / 2T and a jerk of (vmax - v0) pi^2 / 2T^2.
+    """
+    dv = vmax - v0
+    t_ramp = max(math.pi * dv / (2 * accel), math.pi * math.sqrt(dv / (2 * jerk)))
+    d_ramp = (v0 + vmax) / 2 * t_ramp
+    # position is monotonic in time, so invert it by interpolation
+    t = np.linspace(0, t_ramp, RAMP_SAMPLES)
+    pos = v0 * t + dv / 2 * (t - t_ramp / math.pi * np.sin(math.pi * t / t_ramp))
+    def time_at(s):
+        return np.interp(s, pos, t)
+    return t_ramp, d_ramp, time_at
+
+def _ramp(profile, v0, vmax, accel, jerk):
+    if profile == SCURVE:
+        return _scurve_ramp(v0, vmax, accel, jerk)
+    return _trapezoid_ramp(v0, vmax, accel)
+
+def step_times(profile, steps, v0, vmax, accel, jerk):
+    """returns the time (secs from start) at which each step completes"""
+    if vmax <= v0:
+        return np.arange(1, steps + 1) / v0
+    t_ramp, d_ramp, time_at = _ramp(profile, v0, vmax, accel, jerk)
+    if 2 * d_ramp > steps:
+        # too short to reach full speed; find the peak we can reach
+        lo, hi = v0, vmax
+        for i in range(40):
+            mid = (lo + hi) / 2
+            if 2 * _ramp(profile, v0, mid, accel, jerk)[1] > steps:
+                hi = mid
+            else:
+                lo = mid
+        vmax = lo
+        if vmax <= v0:
+            return np.arange(1, steps + 1) / v0
+        t_ramp, d_ramp, time_at = _ramp(profile, v0, vmax, accel, jerk)
+    s = np.arange(1, steps + 1, dtype=float)
+    cruise_time = (steps - 2 * d_ramp) / vmax
+    total = 2 * t_ramp + cruise_time
+    return np.where(
+        s <= d_ramp, time_at(np.minimum(s, d_ramp)),
+        np.where(s <= steps - d_ramp,
+                 t_ramp + (s - d_ramp) / vmax,
+                 total - time_at(np.maximum(steps - s, 0))))
+
+@lru_cache(maxsize=16)
+def half_periods(profile, steps, v0=None, vmax=None, accel=None, jerk=None):
+    """returns a tuple of per-step half periods (secs) for a move of steps
+
+    Results are cached, since the door makes the same few moves over
+    and over.
+    """
+    v0 = config.STEPPER_START_SPEED if v0 is None else v0
+    vmax = config.STEPPER_MAX_SPEED if vmax is None else vmax
+    accel = config.STEPPER_ACCEL if accel is None else accel
+    jerk = config.STEPPER_JERK if jerk is None else jerk
+    if steps <= 0:
+        return ()
+    times = step_times(profile, steps, v0, vmax, accel, jerk)
+    intervals = np.diff(times, prepend=0.0)
+    return tuple((intervals / 2).tolist())
+
+def plan_move(direction, steps, step_delay, profile=None):
+    """returns a Move of steps steps using the configured profile"""
+    if profile is None:
+        profile = config.STEPPER_PROFILE
+    if profile == CONSTANT:
+        return compile_move(direction, steps, step_delay)
+    return Move(direction, half_periods(profile, steps))
+
+def profile_stats(half_periods):
+    """returns duration, peak speed and peak accel of a list of half periods"""
+    intervals = 2 * np.asarray(half_periods, dtype=float)
+    if not len(intervals):
+        return {"duration": 0.0, "max_speed": 0.0, "max_accel": 0.0}
+    speeds = 1 / intervals
+    times = np.cumsum(intervals)
+    accels = np.abs(np.diff(speeds)) / intervals[1:] if len(intervals) > 1 else np.zeros(1)
+    return {
+        "duration": float(times[-1]),
+        "max_speed": float(speeds.max()),
+        "max_accel": float(accels.max()),
+    }
+
+def timing_error(half_periods, edges):
+    """compares recorded (time, pin, level) step edges to the plan
+
+    edges as recorded by motion.SimulatedBackend (first edge is the
+    direction pin). Returns the mean and worst lateness in secs.
+    """
+    ideal = np.concatenate(([0.0], np.cumsum(np.repeat(half_periods, 2))[:-1]))
+    actual = np.array([edge[0] for edge in edges[1:]], dtype=float)
+    n = min(len(ideal), len(actual))
+    if n == 0:
+        return 0.0, 0.0
+    lateness = actual[:n] - ideal[:n]
+    return float(lateness.mean()), float(lateness.max())
+
+
+def main():
+    from motion import SimulatedBackend
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.DEBUG
+    )
+    # compare the profiles for a full door move, optionally replaying
+    # each through the simulator in real time to see how well it's held
+    realtime = "--realtime" in sys.argv
+    steps = config.REVS * config.SPR
+    for profile in (CONSTANT, TRAPEZOID, SCURVE):
+        move = plan_move(1, steps, 1 / config.SPR, profile)
+        stats = profile_stats(move.half_periods)
+        logging.info("Planner:%s:%.2fs, peak %.0f steps/s, peak accel %.0f steps/s^2",
+                     profile, stats["duration"], stats["max_speed"], stats["max_accel"])
+        if realtime:
+            sim = SimulatedBackend(config.DIR_PIN, config.STEP_PIN, realtime=True)
+            sim.run(move)
+            mean, worst = timing_error(move.half_periods, sim.edges)
+            logging.info("Planner:%s:edge lateness mean %.3fms, worst %.2fms",
+                         profile, mean * 1000, worst * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+# scheduler.py - event scheduler for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import heapq
+import itertools
+import threading
+import time
+import clock
+import metrics
+import logging
+
+
+class Scheduler(object):
+    """timer heap of named events that sleeps until the next one is due
+
+    Each event is a callback registered under a name. When it comes due,
+    the callback is run on the scheduler thread. If it returns a number,
+    that is taken as the (epoch) time the event should run next; if it
+    returns None, the event is dropped. Scheduling a name that is already
+    on the heap replaces the old entry.
+    """
+
+    def __init__(self, max_sleep=None):
+        # cap on how long we sleep in one go, so a wall clock jump (the
+        # Pi has no RTC and NTP can move the clock after boot) can't
+        # leave us asleep past an event
+        self.max_sleep = max_sleep
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        # the event whose callback is running, and events woken meanwhile
+        self.current = None
+        self.woken = set()
+        # events run so far
+        self.runs = 0
+
+    def schedule(self, name, when, callback):
+        """schedule callback to run at epoch time when (thread-safe)"""
+        with self.cond:
+            entry = [when, next(self.counter), name, callback]
+            old = self.entries.get(name)
+            if old is not None:
+                # lazy delete: mark the old entry dead, skip it when popped
+                old[3] = None
+            self.entries[name] = entry
+            heapq.heappush(self.heap, entry)
+            logging.debug("Scheduler:Scheduled %s at %s", name, time.ctime(when))
+            self.cond.notify()
+
+    def schedule_in(self, name, delay, callback):
+        """schedule callback to run delay seconds from now"""
+        self.schedule(name, clock.time() + delay, callback)
+
+    def wake(self, name):
+        """make an already scheduled event due now (thread-safe)
+
+        If the event is running, it runs again as soon as it returns
+        (unless it drops itself by returning None).
+        """
+        with self.cond:
+            entry = self.entries.get(name)
+            if entry is None:
+                if name != self.current:
+                    return False
+                self.woken.add(name)
+                return True
+            self.schedule(name, clock.time(), entry[3])
+            return True
+
+    def cancel(self, name):
+        with self.cond:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                entry[3] = None
+                self.cond.notify()
+
+    def next_due(self):
+        """returns the epoch time of the next live event, or None"""
+        with self.cond:
+            self._discard_dead()
+            if self.heap:
+                return self.heap[0][0]
+            return None
+
+    def _discard_dead(self):
+        while self.heap and self.heap[0][3] is None:
+            heapq.heappop(self.heap)
+
+    def _next_event(self):
+        """block until an event is due; returns (name, callback) or None"""
+        with self.cond:
+            while self.running:
+                self._discard_dead()
+                if self.heap:
+                    timeout = self.heap[0][0] - clock.time()
+                    if timeout <= 0:
+                        when, count, name, callback = heapq.heappop(self.heap)
+                        del self.entries[name]
+                        self.current = name
+                        metrics.observe("scheduler_lateness_seconds", -timeout, event=name)
+                        return name, callback
+                else:
+                    timeout = None
+                if self.max_sleep is not None:
+                    timeout = self.max_sleep if timeout is None else min(timeout, self.max_sleep)
+                clock.wait(self.cond, timeout)
+            return None
+
+    def run(self):
+        """run events as they come due until stop() is called"""
+        self.running = True
+        while self.running:
+            event = self._next_event()
+            if event is None:
+                break
+            name, callback = event
+            logging.debug("Scheduler:Running %s", name)
+            self.runs += 1
+            metrics.inc("scheduler_events_total", event=name)
+            try:
+                with metrics.timed("event_seconds", event=name):
+                    when = callback()
+            except:
+                logging.exception("Scheduler:Event %s failed", name)
+                raise
+            with self.cond:
+                self.current = None
+                if name in self.woken:
+                    # woken while it ran; what it woke for may not be handled
+                    self.woken.discard(name)
+                    if when is not None:
+                        when = min(when, clock.time())
+                # the callback may have rescheduled itself already
+                if when is not None and name not in self.entries:
+                    self.schedule(name, when, callback)
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
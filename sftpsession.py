@@ -0,0 +1,137 @@
+# sftpsession.py - shared sftp session for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+from lazyimport import lazy_import
+import logging
+
+# imported on first connect
+pysftp = lazy_import("pysftp")
+paramiko = lazy_import("paramiko")
+
+logging.getLogger("paramiko").setLevel(config.SFTP_LOG_LEVEL)
+logging.getLogger('paramiko.transport').setLevel(config.SFTP_LOG_LEVEL)
+
+
+class SftpUnavailable(Exception):
+    """raised while we are backing off after a failed connect"""
+
+
+class SftpSession(object):
+    """one long-lived sftp connection shared by every upload path
+
+    The connection is opened on first use and kept alive with transport
+    keepalives. If it drops, the next user reconnects; if connecting
+    fails, further attempts are refused until an exponential backoff has
+    passed, so a dead uplink doesn't stall every caller for a timeout.
+    """
+
+    def __init__(self, host, username, password, log=None,
+                 keepalive=None, min_backoff=None, max_backoff=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.log = log
+        self.keepalive = config.SFTP_KEEPALIVE if keepalive is None else keepalive
+        self.min_backoff = config.SFTP_MIN_BACKOFF if min_backoff is None else min_backoff
+        self.max_backoff = config.SFTP_MAX_BACKOFF if max_backoff is None else max_backoff
+        self.backoff = self.min_backoff
+        self.retry_at = 0
+        self.sftp = None
+        self.lock = threading.RLock()
+        self.handshakes = 0
+
+    def _is_alive(self):
+        # pysftp doesn't expose the paramiko transport publicly
+        try:
+            return self.sftp._transport.is_active()
+        except:
+            return False
+
+    def _connect(self):
+        if self.sftp is not None:
+            if self._is_alive():
+                return self.sftp
+            logging.info("SFTP:Connection dropped")
+            self._drop()
+        now = time.time()
+        if now < self.retry_at:
+            raise SftpUnavailable(f"backing off for {self.retry_at - now:.0f}s")
+        cnopts = pysftp.CnOpts()
+        cnopts.hostkeys = None
+        logging.info("SFTP:Connecting to %s", self.host)
+        try:
+            self.handshakes += 1
+            with metrics.stage("sftp_connect"):
+                self.sftp = pysftp.Connection(host=self.host,
+                                              username=self.username,
+                                              password=self.password,
+                                              log=self.log,
+                                              cnopts=cnopts)
+        except:
+            self.retry_at = now + self.backoff
+            logging.warning("SFTP:Failed to connect, retrying in %ss", self.backoff)
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            raise
+        self.backoff = self.min_backoff
+        self.retry_at = 0
+        if self.keepalive:
+            self.sftp._transport.set_keepalive(self.keepalive)
+        return self.sftp
+
+    def _drop(self):
+        try:
+            self.sftp.close()
+        except:
+            pass
+        self.sftp = None
+
+    @contextmanager
+    def connection(self):
+        """yields a connected pysftp.Connection, held exclusively
+
+        Callers should change directory with sftp.cd() so the shared
+        connection is left where they found it.
+        """
+        with self.lock:
+            yield self._connect()
+
+    def open_channel(self):
+        """returns an extra paramiko SFTPClient on the current transport
+
+        Only call this from inside connection(). The caller closes it.
+        """
+        with self.lock:
+            return paramiko.SFTPClient.from_transport(self._connect()._transport)
+
+    def close(self):
+        with self.lock:
+            if self.sftp is not None:
+                self._drop()
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """returns the process-wide sftp session, creating it on first call"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = SftpSession(config.SFTP_SERVER,
+                                   config.SFTP_USER,
+                                   config.SFTP_PASSWORD,
+                                   log=config.SFTP_LOG)
+        return _session
+
+def set_session(session):
+    """replace the process-wide session (a simulation swaps in a fake)"""
+    global _session
+    with _session_lock:
+        _session = session
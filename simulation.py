@@ -0,0 +1,412 @@
+# simulation.py - time-warp simulation for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+# Runs the real Chickenrobot on_duty loop against a SimClock and fakes
+# of everything outside the Pi: GPIO, the cams, twilio and the sftp
+# server. No pins, cams or servers are touched and no real time passes
+# waiting, so months of sunrises, sunsets and texts replay in seconds.
+#
+#   python simulation.py --days 365 --sms-per-day 2 --actions
+
+import sys
+import os
+import types
+import random
+import argparse
+import tempfile
+import itertools
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from dateutil import tz
+import time as _time
+
+
+def _install_fake_gpio():
+    """put an in-memory RPi.GPIO in place before anything imports the real one"""
+    gpio = types.ModuleType("RPi.GPIO")
+    gpio.BOARD, gpio.BCM = 10, 11
+    gpio.OUT, gpio.IN = 0, 1
+    gpio.LOW, gpio.HIGH = 0, 1
+    gpio.levels = {}
+    def output(pin, level):
+        gpio.levels[pin] = level
+    gpio.output = output
+    gpio.input = lambda pin: gpio.levels.get(pin, gpio.LOW)
+    gpio.setwarnings = lambda flag: None
+    gpio.setmode = lambda mode: None
+    gpio.setup = lambda pin, mode, **kwargs: None
+    gpio.cleanup = lambda *args: None
+    rpi = types.ModuleType("RPi")
+    rpi.GPIO = gpio
+    sys.modules['RPi'] = rpi
+    sys.modules['RPi.GPIO'] = gpio
+    return gpio
+
+GPIO = _install_fake_gpio()
+# config insists on these; nothing here ever uses them
+for name in ("SFTP_PASSWORD", "TWILIO_ACCOUNT_SID", "TWILIO_AUTH_TOKEN"):
+    os.environ.setdefault(name, "simulated")
+
+import config
+import clock
+import sftpsession
+import door
+import numpy as np
+import logging
+
+# what our simulated flock texts, roughly in proportion
+SMS_BODIES = ["status", "status", "photo", "photo new", "open", "close",
+              "door", "sun", "cam", "help", "stop", "hello robot"]
+STRANGER_NUM = "+15555550100"
+# the coop's time zone (config's Felton, CA), whatever the host's is
+COOP_TZ = "America/Los_Angeles"
+
+
+class FakeCapture(object):
+    """a cam that returns a synthetic frame, brighter around midday
+
+    Stands in for cv.VideoCapture; only cam numbers below cam_count open.
+    """
+
+    def __init__(self, cam_num, cam_count):
+        self.cam_num = cam_num
+        self.opened = cam_num < cam_count
+        self.width = config.MAX_HORZ
+        self.height = config.MAX_VERT
+        self.base = None
+
+    def isOpened(self):
+        return self.opened
+
+    def set(self, prop, value):
+        return True
+
+    def read(self):
+        if not self.opened:
+            return False, None
+        if self.base is None:
+            # a gradient with a block per cam, so the cams tell apart
+            ramp = np.linspace(0, 40, self.width, dtype=np.uint8)
+            self.base = np.repeat(np.tile(ramp, (self.height, 1))[:, :, None], 3, axis=2)
+            block = self.height // 4
+            self.base[block:2 * block, block * (self.cam_num + 1):block * (self.cam_num + 2)] = 35
+        hour = clock.now().hour + clock.now().minute / 60
+        level = int(20 + 180 * max(0.0, 1 - abs(hour - 12) / 7))
+        return True, self.base + level
+
+    def release(self):
+        pass
+
+
+class FakeMessage(object):
+    def __init__(self, sid, from_, to, body, media_url=None):
+        self.sid = sid
+        self.from_ = from_
+        self.to = to
+        self.body = body
+        self.media_url = media_url or []
+        self.date_sent = clock.now()
+
+
+class FakeMessageList(object):
+    """client.messages: create(), list() and messages(sid).delete()"""
+
+    def __init__(self, twilio):
+        self.twilio = twilio
+
+    def create(self, from_, to, body="", media_url=None):
+        return self.twilio._add(self.twilio.sent, from_, to, body, media_url)
+
+    def list(self, to=None, date_sent_after=None):
+        with self.twilio.lock:
+            msgs = [msg for msg in self.twilio.inbox.values()
+                    if (to is None or msg.to == to) and
+                       (date_sent_after is None or msg.date_sent > date_sent_after)]
+        # newest first, like twilio
+        return sorted(msgs, key=lambda msg: msg.date_sent, reverse=True)
+
+    def __call__(self, sid):
+        twilio = self.twilio
+        class Context(object):
+            def delete(self):
+                with twilio.lock:
+                    return twilio.inbox.pop(sid, None) is not None
+        return Context()
+
+
+class FakeTwilio(object):
+    """the bits of twilio.rest.Client that Comms uses, over an in-memory store"""
+
+    def __init__(self, origin_num):
+        self.origin_num = origin_num
+        self.lock = threading.Lock()
+        self.sids = itertools.count(1)
+        self.inbox = {}
+        self.sent = []
+        self.received = 0
+        self.messages = FakeMessageList(self)
+
+    def _add(self, box, from_, to, body, media_url=None):
+        with self.lock:
+            msg = FakeMessage(f"SM{next(self.sids):032d}", from_, to, body, media_url)
+            if isinstance(box, dict):
+                box[msg.sid] = msg
+            else:
+                box.append(msg)
+            return msg
+
+    def receive(self, from_, body):
+        """an sms arrives for us"""
+        self.received += 1
+        return self._add(self.inbox, from_, self.origin_num, body)
+
+
+class FakeSftp(object):
+    """an sftp server in a dict of remote path to size"""
+
+    def __init__(self):
+        self.files = {}
+        self.cwd = "."
+        self.sftp_client = self
+        self.puts = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def _path(self, path):
+        return path if path.startswith("/") else self.cwd + "/" + path
+
+    @contextmanager
+    def cd(self, path):
+        old, self.cwd = self.cwd, path
+        try:
+            yield
+        finally:
+            self.cwd = old
+
+    def _store(self, path, size):
+        with self.lock:
+            self.files[self._path(path)] = size
+            self.puts += 1
+            self.bytes += size
+
+    def put(self, localpath, remotepath=None):
+        self._store(remotepath or os.path.basename(localpath), os.path.getsize(localpath))
+
+    def putfo(self, fo, remotepath, file_size=0, **kwargs):
+        self._store(remotepath, len(fo.read()))
+
+    def listdir(self, path="."):
+        prefix = self._path(path).rstrip("/") + "/"
+        with self.lock:
+            return [name[len(prefix):] for name in self.files
+                    if name.startswith(prefix) and "/" not in name[len(prefix):]]
+
+    def remove(self, path):
+        with self.lock:
+            if self.files.pop(self._path(path), None) is None:
+                raise IOError(path)
+
+    def posix_rename(self, oldpath, newpath):
+        with self.lock:
+            self.files[self._path(newpath)] = self.files.pop(self._path(oldpath))
+
+    rename = posix_rename
+
+    def close(self):
+        pass
+
+
+class FakeSftpSession(object):
+    """stands in for sftpsession.SftpSession"""
+
+    def __init__(self):
+        self.sftp = FakeSftp()
+        self.lock = threading.RLock()
+        self.handshakes = 0
+
+    @contextmanager
+    def connection(self):
+        with self.lock:
+            yield self.sftp
+
+    def open_channel(self):
+        return self.sftp
+
+    def close(self):
+        pass
+
+
+class Simulation(object):
+    """drives a Chickenrobot through days of simulated time
+
+    Texts arrive at random times from the subscribers (and now and then
+    from a stranger). Every door move is recorded as it finishes.
+    """
+
+    def __init__(self, start, days, sms_per_day=1.0, cams=2, seed=0, poll_interval=60,
+                 frame_size=(320, 240)):
+        self.start = start
+        self.days = days
+        self.sms_per_day = sms_per_day
+        self.cams = cams
+        self.random = random.Random(seed)
+        self.poll_interval = poll_interval
+        self.frame_size = frame_size
+        self.workdir = tempfile.mkdtemp(prefix="chickenrobot-sim-")
+        self.actions = []
+        self.robot = None
+        self.twilio = None
+        self.session = None
+
+    def _configure(self):
+        # keep everything we'd write out of the real state files
+        config.DOOR_STATE_FILE = os.path.join(self.workdir, "door.state")
+        config.DOOR_JOURNAL_FILE = os.path.join(self.workdir, "door.journal")
+        config.DOOR_SNAPSHOT_FILE = os.path.join(self.workdir, "door.snapshot")
+        config.STATUS_FILE = os.path.join(self.workdir, "status.html")
+        config.STATUS_JSON_FILE = os.path.join(self.workdir, "status.json")
+        config.NOIMAGE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), config.NOIMAGE_FILE)
+        config.ARCHIVE_IMAGES = False
+        config.LOCAL_SERVER_PORT = 0
+        config.STEPPER_BACKEND = "sim"
+        config.CAMERA_WARM = False
+        config.COMMAND_MODE = "poll"
+        config.COMMAND_POLL_INTERVAL = self.poll_interval
+        config.SEND_RETRY_DELAY = 0
+        config.MAX_CAMS = max(self.cams, 1)
+        config.MAX_HORZ, config.MAX_VERT = self.frame_size
+
+    def _sms_times(self):
+        """when each text arrives, spread at random over the run"""
+        start = self.start.timestamp()
+        span = self.days * 86400
+        count = int(self.days * self.sms_per_day)
+        return sorted(start + self.random.random() * span for i in range(count))
+
+    def _deliver(self, arrivals):
+        """a scheduler event: the next text arrives; returns when the one after does"""
+        if self.random.random() < 0.1:
+            from_num = STRANGER_NUM
+        else:
+            from_num = self.random.choice(config.TARGET_NUMS)
+        self.twilio.receive(from_num, self.random.choice(SMS_BODIES))
+        return next(arrivals, None)
+
+    def _door_moved(self, door_moved):
+        """wraps Chickenrobot.door_moved to record each finished move"""
+        def recorded():
+            robot = self.robot
+            self.actions.append((clock.now(), robot.door.state, robot.door.mode,
+                                 robot.move_requester or "auto"))
+            return door_moved()
+        return recorded
+
+    def run(self):
+        """run the whole simulation; returns a dict of results"""
+        from chickenrobot import Chickenrobot
+        self._configure()
+        sim_clock = clock.SimClock(self.start.timestamp())
+        clock.set_clock(sim_clock)
+        self.twilio = FakeTwilio(config.ORIGIN_NUM)
+        self.session = FakeSftpSession()
+        sftpsession.set_session(self.session)
+        try:
+            self.robot = robot = Chickenrobot(
+                twilio_client=self.twilio,
+                capture_factory=lambda cam_num: FakeCapture(cam_num, self.cams))
+            robot.door_moved = self._door_moved(robot.door_moved)
+            # time stands still while the door is moving
+            sim_clock.hold_while(robot.door.actuator.is_busy)
+            end = self.start.timestamp() + self.days * 86400
+            arrivals = iter(self._sms_times())
+            first = next(arrivals, None)
+            if first is not None:
+                robot.scheduler.schedule("sms", first, lambda: self._deliver(arrivals))
+            robot.scheduler.schedule("end", end, lambda: robot.scheduler.stop())
+            started = _time.perf_counter()
+            robot.on_duty()
+            robot.door.wait()
+            wall = _time.perf_counter() - started
+            robot.comms.executor.shutdown(wait=True)
+            if robot.camera.image_sync.delete_thread is not None:
+                robot.camera.image_sync.delete_thread.join()
+        finally:
+            clock.set_clock(clock.Clock())
+        return self.results(wall)
+
+    def results(self, wall):
+        sent = self.twilio.sent
+        simulated = self.days * 86400
+        return {
+            "days": self.days,
+            "wall_secs": wall,
+            "speedup": simulated / wall if wall else float("inf"),
+            "events": self.robot.scheduler.runs,
+            "events_per_sec": self.robot.scheduler.runs / wall if wall else 0.0,
+            "door_moves": len(self.actions),
+            "opens": sum(1 for action in self.actions if action[1] == door.OPEN),
+            "closes": sum(1 for action in self.actions if action[1] == door.CLOSED),
+            "manual_moves": sum(1 for action in self.actions if action[3] != "auto"),
+            "sms_received": self.twilio.received,
+            "texts_sent": sum(1 for msg in sent if not msg.media_url),
+            "mms_sent": sum(1 for msg in sent if msg.media_url),
+            "uploads": self.session.sftp.puts,
+            "upload_bytes": self.session.sftp.bytes,
+        }
+
+
+STATE_NAMES = {door.CLOSED: "closed", door.OPEN: "open", door.PARTIAL: "partial"}
+MODE_NAMES = {door.AUTO: "auto", door.MANUAL: "manual"}
+
+def pin_timezone(zone):
+    """run in zone, so sunrise, sunset and the local day line up as at the coop"""
+    os.environ["TZ"] = zone
+    _time.tzset()
+    clock.to_zone = tz.tzlocal()
+
+def main():
+    parser = argparse.ArgumentParser(description="replay days of chickenrobot in simulated time")
+    parser.add_argument("--days", type=float, default=30, help="days to simulate")
+    parser.add_argument("--start", default=None, help="first day, YYYY-MM-DD (default today)")
+    parser.add_argument("--sms-per-day", type=float, default=1.0, help="texts arriving per day")
+    parser.add_argument("--cams", type=int, default=2, help="synthetic cams")
+    parser.add_argument("--frame", default="320x240", help="synthetic frame size WxH")
+    parser.add_argument("--poll", type=float, default=60, help="secs between sms checks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tz", default=COOP_TZ, help=f"time zone to run in (default {COOP_TZ})")
+    parser.add_argument("--actions", action="store_true", help="list every door move")
+    parser.add_argument("--verbose", action="store_true", help="log at INFO")
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.INFO if args.verbose else logging.WARNING
+    )
+    pin_timezone(args.tz)
+    if args.start:
+        start = datetime.strptime(args.start, "%Y-%m-%d").astimezone(clock.to_zone)
+    else:
+        start = datetime.now().astimezone(clock.to_zone).replace(hour=0, minute=0, second=0, microsecond=0)
+    width, height = (int(v) for v in args.frame.lower().split("x"))
+    sim = Simulation(start, args.days, args.sms_per_day, args.cams, args.seed,
+                     args.poll, (width, height))
+    results = sim.run()
+    if args.actions:
+        for when, state, mode, requester in sim.actions:
+            print(f"{when:%Y-%m-%d %H:%M}  {STATE_NAMES.get(state, state):8} "
+                  f"{MODE_NAMES.get(mode, mode):7} {requester}")
+    print(f"Simulated {results['days']:g} days in {results['wall_secs']:.2f}s "
+          f"({results['speedup']:,.0f}x real time)")
+    print(f"Scheduler events: {results['events']} ({results['events_per_sec']:,.0f}/s)")
+    print(f"Door moves: {results['door_moves']} ({results['opens']} open, "
+          f"{results['closes']} close, {results['manual_moves']} by text)")
+    print(f"Texts in: {results['sms_received']}, sms out: {results['texts_sent']}, "
+          f"mms out: {results['mms_sent']}")
+    print(f"Uploads: {results['uploads']} ({results['upload_bytes'] / 1e6:.1f}MB)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# status.py - status page renderer for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import os
+import json
+import hashlib
+import html
+import threading
+from string import Template
+import sftpsession
+import clock
+import metrics
+import logging
+
+# Compiled once; render() only fills them in
+PAGE_TEMPLATE = Template(
+    '<div class="status"><pre style="white-space:pre-wrap;word-wrap:break-word;">$status</pre></div>'
+    '<div class="images">$images</div>'
+    '<div class="image-text"><pre>$image_text</pre></div>')
+IMAGE_TEMPLATE = Template('<a href="$full"><img src="$thumb" style="$style"></a>')
+NO_PHOTOS_TEXT = "No cameras available, so no photos."
+
+
+def _write_atomic(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+class StatusPage(object):
+    """renders status.html and status.json, and uploads them when they change
+
+    What counts as a change is the status itself and which photos are
+    shown. The random sign-on and sign-off and the timestamp don't, so
+    a report that says nothing new costs no upload at all. Files go up
+    under a temporary name and are renamed into place, so a reader never
+    sees a half-written page.
+
+    The local server's copy is kept in self.local as (hash, html bytes,
+    json bytes), with photo links relative to itself. With upload off,
+    that and the files on disk are all there is.
+    """
+
+    def __init__(self, html_path=None, json_path=None, remote_dir=None, session=None, upload=None):
+        self.html_path = config.STATUS_FILE if html_path is None else html_path
+        self.json_path = config.STATUS_JSON_FILE if json_path is None else json_path
+        self.remote_dir = config.SFTP_MAIN_DIR if remote_dir is None else remote_dir
+        self.session = session
+        self.upload = config.REMOTE_UPLOAD if upload is None else upload
+        self.lock = threading.Lock()
+        # hash of what was last uploaded, and of what's on disk
+        self.uploaded_hash = None
+        self.last = None
+        self.local = None
+
+    def content(self, status_text, image_text, full, thumb, mms=None, url_base=None):
+        """returns the substantive content of a page as a dict"""
+        if url_base is None:
+            url_base = config.IMAGE_URL_BASE
+        if not full:
+            image_text = NO_PHOTOS_TEXT
+        mms = mms or full
+        images = [{"full": url_base + f,
+                   "thumb": url_base + t,
+                   "mms": url_base + m}
+                  for f, t, m in zip(full, thumb, mms)]
+        return {"status": status_text.strip(), "image_text": image_text.strip(), "images": images}
+
+    @staticmethod
+    def content_hash(content):
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def render_html(self, content, signon="", signoff=""):
+        images = "".join(IMAGE_TEMPLATE.substitute(full=html.escape(image["full"]),
+                                                   thumb=html.escape(image["thumb"]),
+                                                   style=config.IMG_STYLE)
+                         for image in content["images"])
+        return PAGE_TEMPLATE.substitute(
+            status=html.escape(signon + content["status"] + "\n", quote=False),
+            images=images,
+            image_text=html.escape(content["image_text"] + "\n" + signoff, quote=False))
+
+    def render_json(self, content, digest):
+        feed = dict(content)
+        feed["updated"] = clock.now().isoformat(timespec="seconds")
+        feed["hash"] = digest
+        return json.dumps(feed, indent=2)
+
+    def publish(self, status_text, image_text, full, thumb, mms=None, signon="", signoff=""):
+        """render and upload the page if its content changed; True if uploaded"""
+        content = self.content(status_text, image_text, full, thumb, mms)
+        digest = self.content_hash(content)
+        with self.lock:
+            if digest != self.last:
+                _write_atomic(self.html_path, self.render_html(content, signon, signoff))
+                _write_atomic(self.json_path, self.render_json(content, digest))
+                local = self.content(status_text, image_text, full, thumb, mms, url_base="")
+                self.local = (digest,
+                              self.render_html(local, signon, signoff).encode('utf-8'),
+                              self.render_json(local, digest).encode('utf-8'))
+                self.last = digest
+            if not self.upload:
+                return False
+            if digest == self.uploaded_hash:
+                logging.info("Status:Unchanged, not uploading")
+                metrics.inc("status_uploads_total", result="unchanged")
+                return False
+            if self._upload():
+                self.uploaded_hash = digest
+                metrics.inc("status_uploads_total", result="uploaded")
+                return True
+            metrics.inc("status_uploads_total", result="failed")
+            return False
+
+    def _upload(self):
+        logging.info("Status:Uploading status")
+        session = self.session or sftpsession.get_session()
+        try:
+            with metrics.stage("status_upload"), session.connection() as sftp:
+                with sftp.cd(self.remote_dir):
+                    for path in (self.html_path, self.json_path):
+                        name = os.path.basename(path)
+                        tmp_name = name + ".tmp"
+                        logging.debug("Status:Uploading %s via sftp", name)
+                        sftp.put(path, tmp_name)
+                        self._rename(sftp, tmp_name, name)
+            return True
+        except:
+            logging.warning("Status:Failed to upload status")
+            return False
+
+    def _rename(self, sftp, tmp_name, name):
+        """move tmp_name over name in one step where the server allows"""
+        try:
+            # the openssh extension replaces the target atomically
+            sftp.sftp_client.posix_rename(tmp_name, name)
+            return
+        except IOError:
+            pass
+        # plain sftp rename won't overwrite; there's a brief gap instead
+        try:
+            sftp.remove(name)
+        except IOError:
+            pass
+        sftp.rename(tmp_name, name)
+
+
+def main():
+    import sys
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.DEBUG
+    )
+    page = StatusPage()
+    content = page.content("The doors are open. ", "Here's photos of the coop. ",
+                           ["images/image.0.jpg"], ["images/image.0.thumb.jpg"])
+    print(page.render_html(content, "Chicken Robot says:\n", "Bawwwk! 🐓🤖"))
+    print(page.render_json(content, page.content_hash(content)))
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,38 @@
 # date: Oct 2020
 # license: MIT
 
+import threading
+
 class StreamToLogger(object):
     """
     Fake file-like stream object that redirects writes to a logger instance.
+
+    Writes are buffered until a newline, so a line printed in pieces
+    (print's separate end write, a traceback written in chunks) comes
+    out as one record. flush() sends on whatever is left.
     """
     def __init__(self, logger, level):
-       self.logger = logger
-       self.level = level
-       self.linebuf = ''
+        self.logger = logger
+        self.level = level
+        self.linebuf = ''
+        self.lock = threading.Lock()
 
     def write(self, buf):
-        for line in buf.rstrip().splitlines():
-            if line != '\n':
-                self.logger.log(self.level, line.rstrip())
+        with self.lock:
+            self.linebuf += buf
+            if '\n' not in buf:
+                return
+            lines = self.linebuf.split('\n')
+            # whatever follows the last newline waits for the rest of its line
+            self.linebuf = lines.pop()
+        for line in lines:
+            line = line.rstrip()
+            if line:
+                self.logger.log(self.level, line)
 
     def flush(self):
-        pass
+        with self.lock:
+            line = self.linebuf.rstrip()
+            self.linebuf = ''
+        if line:
+            self.logger.log(self.level, line)
@@ -0,0 +1,332 @@
+# vision.py - doorway check for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import os
+import time
+import threading
+import multiprocessing
+from collections import namedtuple
+from lazyimport import lazy_import
+from change import changed_fraction, load_mask
+import metrics
+import logging
+
+cv = lazy_import("cv2")
+np = lazy_import("numpy")
+
+# Before the door closes on its own, we look through the doorway: a
+# short burst of small grayscale frames goes to a worker process, which
+# answers with one of these. The worker is a separate process so that
+# inference never holds the GIL (or the core) the stepper and comms
+# threads need, and if it hangs or dies we just get UNKNOWN.
+CLEAR = "clear"
+OBSTRUCTED = "obstructed"   # something sits in the doorway
+ANIMAL = "animal"           # something moves, or the model sees an animal
+UNKNOWN = "unknown"         # no frames, or no answer within the budget
+
+Verdict = namedtuple("Verdict", ["result", "score", "secs"])
+
+# what MobileNet-SSD, the usual opencv dnn example, was trained on
+SSD_CLASSES = ["background", "aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car",
+               "cat", "chair", "cow", "diningtable", "dog", "horse", "motorbike", "person",
+               "pottedplant", "sheep", "sofa", "train", "tvmonitor"]
+# how much of each clear look goes into the picture of the empty doorway
+REFERENCE_ALPHA = 0.3
+
+
+class DoorwayClassifier(object):
+    """decides from a burst of frames whether the doorway is clear
+
+    If a dnn model is set and sees one of animal_classes, or enough of
+    the doorway changes from one frame of the burst to the next, it's
+    ANIMAL. If the doorway differs from how it looked when last clear,
+    it's OBSTRUCTED. Otherwise it's CLEAR, and the burst goes into the
+    picture of the empty doorway; until there is one, only movement
+    can be seen.
+    """
+
+    def __init__(self, threshold, min_fraction, mask_file="", model="", model_config="",
+                 animal_classes=(), confidence=0.5):
+        self.threshold = threshold
+        self.min_fraction = min_fraction
+        self.mask_file = mask_file
+        self.mask = None
+        self.mask_shape = None
+        self.net = None
+        if model:
+            try:
+                self.net = cv.dnn.readNet(model, model_config)
+            except Exception as e:
+                logging.warning("Vision:Failed to load model %s:%s", model, e)
+        self.animal_classes = set(animal_classes)
+        self.confidence = confidence
+        self.reference = None
+
+    def _mask(self, shape):
+        if shape != self.mask_shape:
+            self.mask = load_mask(self.mask_file, shape)
+            self.mask_shape = shape
+        return self.mask
+
+    def _animal_score(self, frame):
+        """returns the model's best confidence in any of our animal classes"""
+        blob = cv.dnn.blobFromImage(cv.cvtColor(frame, cv.COLOR_GRAY2BGR), 0.007843, (300, 300), 127.5)
+        self.net.setInput(blob)
+        best = 0.0
+        # each detection is [image, class, confidence, box...]
+        for detection in self.net.forward().reshape(-1, 7):
+            class_id = int(detection[1])
+            if 0 <= class_id < len(SSD_CLASSES) and SSD_CLASSES[class_id] in self.animal_classes:
+                best = max(best, float(detection[2]))
+        return best
+
+    def classify(self, frames):
+        """returns (result, score) for a list of grayscale frames"""
+        if not frames:
+            return UNKNOWN, 0.0
+        if self.net is not None:
+            score = self._animal_score(frames[-1])
+            if score >= self.confidence:
+                return ANIMAL, score
+        frames = [frame.astype(np.float32) for frame in frames]
+        mask = self._mask(frames[0].shape)
+        motion = max((changed_fraction(b, a, self.threshold, mask) for a, b in zip(frames, frames[1:])),
+                     default=0.0)
+        if motion >= self.min_fraction:
+            return ANIMAL, motion
+        last = frames[-1]
+        if self.reference is None or self.reference.shape != last.shape:
+            self.reference = last
+            return CLEAR, 0.0
+        fraction = changed_fraction(last, self.reference, self.threshold, mask)
+        if fraction >= self.min_fraction:
+            return OBSTRUCTED, fraction
+        self.reference += REFERENCE_ALPHA * (last - self.reference)
+        return CLEAR, fraction
+
+    def relearn(self, frames):
+        """take the last of frames as how the empty doorway looks now
+
+        For when the doorway has changed for good (a feeder moved, the
+        door reframed) and every look would otherwise be OBSTRUCTED.
+        """
+        if frames:
+            self.reference = frames[-1].astype(np.float32)
+
+
+def classifier_settings():
+    """the DoorwayClassifier arguments, from config"""
+    return {
+        "threshold": config.VISION_THRESHOLD,
+        "min_fraction": config.VISION_MIN_FRACTION,
+        "mask_file": config.VISION_MASK_FILE,
+        "model": config.VISION_MODEL,
+        "model_config": config.VISION_MODEL_CONFIG,
+        "animal_classes": list(config.VISION_ANIMAL_CLASSES),
+        "confidence": config.VISION_CONFIDENCE,
+    }
+
+def _serve(conn, settings):
+    """the worker process: classify bursts until told to stop"""
+    classifier = DoorwayClassifier(**settings)
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        request_id, frames, relearn = request
+        if relearn:
+            try:
+                classifier.relearn(frames)
+            except Exception:
+                pass
+            continue
+        try:
+            result, score = classifier.classify(frames)
+            error = None
+        except Exception as e:
+            result, score, error = UNKNOWN, 0.0, repr(e)
+        conn.send((request_id, result, score, error))
+
+
+class VisionWorker(object):
+    """runs a DoorwayClassifier in its own process, answering within a budget
+
+    The process is started on first use (or by start()) and started
+    again if it dies. An answer that comes after the budget is thrown
+    away when it turns up.
+    """
+
+    def __init__(self, budget=None, settings=None):
+        self.budget = config.VISION_BUDGET if budget is None else budget
+        self.settings = classifier_settings() if settings is None else settings
+        # fork would copy our threads' locks mid-use; start clean
+        self.context = multiprocessing.get_context("spawn")
+        self.process = None
+        self.conn = None
+        self.request_id = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            self._start()
+        return self
+
+    def _start(self):
+        if self.process is not None and self.process.is_alive():
+            return
+        self._stop()
+        conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=_serve, args=(child_conn, self.settings),
+                                            name="vision", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.conn = conn
+        logging.info("Vision:Worker started (pid %s)", self.process.pid)
+
+    def check(self, frames):
+        """returns a Verdict on a burst of frames, UNKNOWN if out of budget"""
+        start = time.perf_counter()
+        with self.lock:
+            result, score = self._ask(frames, start + self.budget)
+        secs = time.perf_counter() - start
+        metrics.inc("vision_checks_total", result=result)
+        metrics.observe("vision_seconds", secs)
+        logging.info("Vision:Doorway %s (%.3f) in %.0fms", result, score, secs * 1000)
+        return Verdict(result, score, secs)
+
+    def _ask(self, frames, deadline):
+        if not frames:
+            return UNKNOWN, 0.0
+        self._start()
+        self.request_id += 1
+        try:
+            self.conn.send((self.request_id, frames, False))
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not self.conn.poll(remaining):
+                    logging.warning("Vision:No answer within %ss", self.budget)
+                    return UNKNOWN, 0.0
+                request_id, result, score, error = self.conn.recv()
+                if request_id == self.request_id:
+                    break
+                # a late answer to a look we gave up on
+        except (EOFError, OSError):
+            logging.warning("Vision:Worker died, will start another")
+            self._stop()
+            return UNKNOWN, 0.0
+        if error:
+            logging.warning("Vision:Worker failed:%s", error)
+        return result, score
+
+    def relearn(self, frames):
+        """have the worker take frames as the empty doorway (no answer)"""
+        if not frames:
+            return
+        with self.lock:
+            self._start()
+            try:
+                self.conn.send((None, frames, True))
+            except (EOFError, OSError):
+                logging.warning("Vision:Worker died, will start another")
+                self._stop()
+                return
+        logging.info("Vision:Relearning the empty doorway")
+
+    def stop(self):
+        with self.lock:
+            self._stop()
+
+    def _stop(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+        self.conn.close()
+        self.process = None
+        self.conn = None
+
+
+def load_bursts(path):
+    """returns [(name, frames)] for the bursts recorded in path
+
+    Files are named <burst>-<frame>.png, as record() writes them.
+    """
+    bursts = {}
+    for filename in sorted(os.listdir(path)):
+        name, ext = os.path.splitext(filename)
+        if ext.lower() not in (".png", ".jpg") or "-" not in name:
+            continue
+        frame = cv.imread(os.path.join(path, filename), cv.IMREAD_GRAYSCALE)
+        if frame is not None:
+            bursts.setdefault(name.rsplit("-", 1)[0], []).append(frame)
+    return sorted(bursts.items())
+
+def record(camera, count, path):
+    """grab count bursts from the doorway cam into path, as load_bursts() reads them"""
+    os.makedirs(path, exist_ok=True)
+    for n in range(count):
+        frames = camera.grab_frames(config.VISION_CAM, config.VISION_FRAMES,
+                                    config.VISION_WIDTH, config.VISION_FRAME_GAP)
+        burst = time.strftime("burst%Y%m%d%H%M%S") + f"{n:03}"
+        for i, frame in enumerate(frames):
+            cv.imwrite(os.path.join(path, f"{burst}-{i}.png"), frame)
+        logging.info("Vision:Recorded %s frames as %s", len(frames), burst)
+
+
+def main():
+    import sys
+    import argparse
+    import statistics
+    parser = argparse.ArgumentParser(description="record doorway bursts, or time the doorway check on them")
+    parser.add_argument("--record", type=int, default=0, help="grab this many bursts from the doorway cam")
+    parser.add_argument("--dir", default=config.VISION_RECORD_DIR, help="where bursts are kept")
+    parser.add_argument("--worker", action="store_true", help="also time round trips to the worker process")
+    args = parser.parse_args()
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.INFO
+    )
+    if args.record:
+        from camera import Camera
+        record(Camera(config.MAX_HORZ, config.MAX_VERT), args.record, args.dir)
+        return
+    bursts = load_bursts(args.dir)
+    if not bursts:
+        print(f"No bursts in {args.dir}; record some with --record")
+        return
+    classifier = DoorwayClassifier(**classifier_settings())
+    times = []
+    for name, frames in bursts:
+        start = time.perf_counter()
+        result, score = classifier.classify(frames)
+        times.append(time.perf_counter() - start)
+        print(f"{name:28} {result:10} {score:6.3f} {times[-1] * 1000:8.2f}ms")
+    print(f"classify: median {statistics.median(times) * 1000:.2f}ms, worst {max(times) * 1000:.2f}ms "
+          f"(budget {config.VISION_BUDGET * 1000:.0f}ms)")
+    if args.worker:
+        # a generous budget, so a slow first answer still counts
+        worker = VisionWorker(budget=60).start()
+        try:
+            worker.check(bursts[0][1])
+            times = [worker.check(frames).secs for name, frames in bursts]
+        finally:
+            worker.stop()
+        print(f"worker round trip: median {statistics.median(times) * 1000:.2f}ms, "
+              f"worst {max(times) * 1000:.2f}ms")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+# webhook.py - inbound sms webhook for chickenrobot, a controller for a coop door and cam controller
+# author: Wes Modes <wmodes@gmail.com>
+# date: Oct 2020
+# license: MIT
+
+import config
+import queue
+import threading
+import urllib.request
+import urllib.error
+from urllib.parse import parse_qs, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from lazyimport import lazy_import
+import logging
+
+twilio_validator = lazy_import("twilio.request_validator")
+
+EMPTY_TWIML = b'<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+
+class WebhookReceiver(object):
+    """accepts twilio's inbound sms webhook and queues the commands
+
+    Twilio POSTs each incoming message to url. We check the
+    X-Twilio-Signature header against our auth token, drop anything not
+    from a subscriber, and put (from_num, cmd, args) on self.queue. on_command,
+    if given, is called after each put so the controller can wake up.
+    """
+
+    def __init__(self, port, url, auth_token, target_nums, parse, on_command=None, host=""):
+        self.port = port
+        self.url = url
+        self.host = host
+        self.validator = twilio_validator.RequestValidator(auth_token)
+        self.target_nums = target_nums
+        self.parse = parse
+        self.on_command = on_command
+        self.queue = queue.Queue()
+        self.server = None
+        self.thread = None
+
+    def _make_handler(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length).decode("utf-8")
+                params = {k: v[0] for k, v in parse_qs(body, keep_blank_values=True).items()}
+                signature = self.headers.get("X-Twilio-Signature", "")
+                if not receiver.validator.validate(receiver.url, params, signature):
+                    logging.warning("Webhook:Rejected request with bad signature")
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+                receiver.handle(params)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/xml")
+                self.send_header("Content-Length", str(len(EMPTY_TWIML)))
+                self.end_headers()
+                self.wfile.write(EMPTY_TWIML)
+
+            def log_message(self, format, *args):
+                logging.debug("Webhook:" + format, *args)
+
+        return Handler
+
+    def handle(self, params):
+        from_num = params.get("From", "")
+        if from_num not in self.target_nums:
+            logging.debug("Webhook:Ignoring msg from number not in sub list:%s", from_num)
+            return
+        cmd, args = self.parse(params.get("Body", ""))
+        logging.info("Webhook:Message received from %s:%s", from_num, cmd)
+        self.queue.put((from_num, cmd, args))
+        if self.on_command:
+            self.on_command()
+
+    def get_commands(self):
+        """returns everything queued so far as a command list"""
+        command_list = []
+        while True:
+            try:
+                command_list.append(self.queue.get_nowait())
+            except queue.Empty:
+                return command_list
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, name="webhook", daemon=True)
+        self.thread.start()
+        logging.info("Webhook:Listening on port %s", self.server.server_address[1])
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def post_fake_sms(post_url, from_num, body, auth_token, signed_url=None):
+    """POST a signed sms webhook like twilio would; returns the http status
+
+    signed_url is the url the receiver validates against, if it differs
+    from the one we actually post to (e.g. behind a tunnel).
+    """
+    params = {
+        "MessageSid": "SMfake",
+        "From": from_num,
+        "To": config.ORIGIN_NUM,
+        "Body": body,
+    }
+    signature = twilio_validator.RequestValidator(auth_token).compute_signature(signed_url or post_url, params)
+    request = urllib.request.Request(post_url, data=urlencode(params).encode("utf-8"),
+                                     headers={"X-Twilio-Signature": signature})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main():
+    import sys
+    from comms import Comms
+    logging.basicConfig(
+        stream=sys.stderr,
+        encoding='utf-8',
+        format='%(asctime)s %(levelname)s:%(message)s',
+        level=logging.DEBUG
+    )
+    # run a receiver on a spare local port and feed it a fake message
+    comms = Comms(config.ORIGIN_NUM, config.TARGET_NUMS)
+    url = "http://127.0.0.1:%s/sms"
+    receiver = WebhookReceiver(0, None, config.TWILIO_AUTH_TOKEN, config.TARGET_NUMS,
+                               comms.parse_command, host="127.0.0.1").start()
+    receiver.url = url % receiver.server.server_address[1]
+    status = post_fake_sms(receiver.url, config.TARGET_NUMS[0], "Send me a photo!", config.TWILIO_AUTH_TOKEN)
+    logging.info("Webhook:Fake post status:%s", status)
+    logging.info("Webhook:Queued commands:%s", receiver.get_commands())
+    receiver.stop()
+
+if __name__ == '__main__':
+    main()